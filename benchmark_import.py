@@ -0,0 +1,361 @@
+import argparse
+import csv
+import gzip
+import http.client
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import import_patients_from_csv as importer
+
+# Benchmark harness for import_patients_from_csv.py. Generates a synthetic clinic CSV,
+# serves a local stand-in for createPatientHttp / addHistoricalVisitBatch / setPatientCounter,
+# and reports throughput, peak RSS, request latency and per-stage time (from ImportMetrics)
+# for each import mode.
+
+MEDICATION_CONTEXT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'functions', 'medication_context_data.json')
+
+CSV_COLUMNS = ["PReg", "Name", "Age", "YMD", "Sex", "TToken", "ContNo", "NICno", "FName", "Address", "Date",
+               "UserID", "Complain", "Examination", "Diagnose", "Investigation", "Advise", "NextPlan", "tAmount",
+               "MName", "DoseInstruc", "DoseforDay"]
+
+ROWS_PER_PATIENT = 12 # Average CSV rows per patient in the clinic exports (visits x medications)
+VISITS_PER_DAY = 40
+
+FIRST_NAMES = ["Muhammad", "Ahmed", "Ali", "Fatima", "Ayesha", "Zainab", "Usman", "Bilal", "Hina", "Sana",
+               "Imran", "Nadia", "Kashif", "Rabia", "Tariq", "Saima", "Asif", "Farah", "Naveed", "Shazia"]
+LAST_NAMES = ["Khan", "Bajwa", "Malik", "Butt", "Chaudhry", "Qureshi", "Sheikh", "Iqbal", "Raza", "Hussain"]
+OCCUPATIONS = ["Teacher", "Farmer", "Shopkeeper", "Student", "Housewife", "Driver", "Labourer", "NULL"]
+CITIES = ["Lahore", "Gujranwala", "Sialkot", "Faisalabad", "Sheikhupura", "Kamoke", "Wazirabad"]
+COMPLAINTS = ["Headache for 2 weeks", "Fits", "Low mood, poor sleep", "Dizziness", "Numbness in hands",
+              "Back pain radiating to leg", "Forgetfulness", "Tremors", "Anxiety, palpitations", ""]
+DIAGNOSES = ["Migraine", "Epilepsy", "Depression", "Vertigo", "Peripheral neuropathy", "Sciatica",
+             "Dementia", "Parkinsonism", "GAD", ""]
+FEES = ["1,500", "2,000", "1000", "500", "0", ""]
+
+# Mock server behaviour, overridable from the command line.
+MOCK_BASE_LATENCY_MS = 150.0
+MOCK_PER_ITEM_LATENCY_MS = 2.0
+MOCK_ITEM_FAILURE_RATE = 0.0 # Per-item failures reported in a 207 errors array
+MOCK_ERROR_RATE = 0.0 # Whole-request 503s
+
+IMPORT_MODES = {
+    "sequential": {"max_in_flight": 1},
+    "concurrent": {"max_in_flight": importer.MAX_IN_FLIGHT_REQUESTS},
+    "concurrent-8": {"max_in_flight": 8},
+    "parallel-parse": {"max_in_flight": importer.MAX_IN_FLIGHT_REQUESTS, "parse_workers": max(2, os.cpu_count() or 2)},
+    "no-gzip": {"max_in_flight": importer.MAX_IN_FLIGHT_REQUESTS, "gzip_bodies": False},
+    "dict": {"max_in_flight": importer.MAX_IN_FLIGHT_REQUESTS, "wire_format": "dict", "gzip_bodies": False},
+    "dict-gzip": {"max_in_flight": importer.MAX_IN_FLIGHT_REQUESTS, "wire_format": "dict"},
+}
+
+def load_medication_vocabulary():
+    with open(MEDICATION_CONTEXT_PATH, mode='r', encoding='utf-8') as context_file:
+        context = json.load(context_file)
+    return context["medicationNames"], context["instructions"], context["durations"]
+
+def patient_demographics(patient_number):
+    """Deterministic demographics so every row of a patient agrees."""
+    rng = random.Random(patient_number)
+    return {
+        "PReg": f"PR-{patient_number}",
+        "Name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "Age": str(rng.randint(1, 90)),
+        "YMD": "Y",
+        "Sex": rng.choice(["M", "F"]),
+        "ContNo": f"03{rng.randint(0, 49):02d}-{rng.randint(0, 9999999):07d}" if rng.random() < 0.8 else "NULL",
+        "NICno": f"34101-{rng.randint(0, 9999999):07d}-{rng.randint(1, 9)}" if rng.random() < 0.3 else "NULL",
+        "FName": rng.choice(OCCUPATIONS),
+        "Address": rng.choice(CITIES),
+    }
+
+def generate_synthetic_clinic_csv(path, rows, seed=1):
+    """Writes a clinic-shaped CSV with about `rows` rows, visits in date order.
+
+    Each visit is written as consecutive rows, one per medication (or one row without
+    an MName), like the real exports. Medication names, instructions and durations are
+    sampled from functions/medication_context_data.json.
+    """
+    rng = random.Random(seed)
+    med_names, instructions, durations = load_medication_vocabulary()
+    patient_count = max(1, rows // ROWS_PER_PATIENT)
+    visit_day = date(2015, 1, 1)
+    visits_today = 0
+    written = 0
+    with open(path, mode='w', encoding='utf-8', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(CSV_COLUMNS)
+        while written < rows:
+            if visits_today >= VISITS_PER_DAY:
+                visit_day += timedelta(days=1)
+                visits_today = 0
+            visits_today += 1
+            patient = patient_demographics(rng.randint(1, patient_count))
+            visit = {
+                "TToken": str(visits_today),
+                "Date": visit_day.strftime('%d/%m/%Y'),
+                "UserID": rng.choice(["1", "2", "3"]),
+                "Complain": rng.choice(COMPLAINTS),
+                "Examination": rng.choice(["NAD", "BP 130/80", "Power 5/5 all limbs", ""]),
+                "Diagnose": rng.choice(DIAGNOSES),
+                "Investigation": rng.choice(["MRI Brain", "EEG", "CBC", "", ""]),
+                "Advise": rng.choice(["Follow up after 2 weeks", "Regular medication", ""]),
+                "NextPlan": rng.choice(["", "Review with reports"]),
+                "tAmount": rng.choice(FEES),
+            }
+            medication_count = rng.choice([0, 1, 2, 2, 3, 3, 4, 5])
+            for medication_index in range(max(1, medication_count)):
+                has_medication = medication_index < medication_count
+                row = {**patient, **visit,
+                       "MName": rng.choice(med_names) if has_medication else "",
+                       "DoseInstruc": rng.choice(instructions) if has_medication else "",
+                       "DoseforDay": rng.choice(durations) if has_medication else ""}
+                writer.writerow([row[column] for column in CSV_COLUMNS])
+                written += 1
+    return written
+
+def decode_import_batch(body, items_key):
+    """Python version of decodeImportBatch() in functions/index.js."""
+    if body.get("encoding") != "dict-v1":
+        return body.get(items_key)
+    strings, string_fields, list_fields = body["strings"], set(body["stringFields"]), body["listFields"]
+    items = []
+    for row in body[items_key]:
+        item = {}
+        for field, value in zip(body["fields"], row):
+            if field in list_fields:
+                value = [{subfield: strings[index] for subfield, index in zip(list_fields[field], entry)} for entry in value]
+            elif field in string_fields:
+                value = strings[value]
+            *parents, name = field.split(".")
+            target = item
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[name] = value
+        items.append(item)
+    return items
+
+class MockFunctionsHandler(BaseHTTPRequestHandler):
+    """Answers like the deployed functions in functions/index.js, with injected latency and errors."""
+
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real endpoints
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            return self._reply(400, {"error": "Invalid JSON"})
+
+        if self.path.endswith("/setPatientCounter"):
+            return self._reply(200, {"success": True, "message": f"Patient counter set to {data.get('lastPRegNumber')}."})
+        if self.path.endswith("/createPatientHttp"):
+            payload_key, id_key = "patients", "pReg"
+        elif self.path.endswith("/addHistoricalVisitBatch"):
+            payload_key, id_key = "visits", "patientId"
+        else:
+            return self._reply(404, {"error": "Not Found"})
+
+        items = decode_import_batch(data, payload_key)
+        if not isinstance(items, list) or not items:
+            return self._reply(400, {"error": f"Missing or empty {payload_key} array."})
+        if payload_key == "visits" and len(items) > 250:
+            return self._reply(400, {"error": "Bad Request: Batch size too large (max 250)."})
+
+        time.sleep((server.base_latency_ms + server.per_item_latency_ms * len(items)) / 1000.0)
+        if server.rng.random() < server.error_rate:
+            return self._reply(503, {"error": "Service Unavailable"})
+
+        errors = []
+        for item in items:
+            if server.rng.random() < server.item_failure_rate:
+                if payload_key == "patients":
+                    errors.append({"pReg": item.get("pReg"), "error": "Injected failure"})
+                else:
+                    errors.append({"patientId": item.get("patientId"), "visitDate": item.get("visitData", {}).get("visitDate"),
+                                   "status": "error", "reason": "Injected failure"})
+        with server.lock:
+            server.requests[payload_key] += 1
+            server.items_accepted[payload_key] += len(items) - len(errors)
+            if payload_key == "patients":
+                server.unique_patients.update(item.get(id_key) for item in items)
+
+        success_count = len(items) - len(errors)
+        if errors:
+            return self._reply(207, {"message": "Batch processed with some failures.", "successCount": success_count,
+                                     "failureCount": len(errors), "totalItems": len(items), "errors": errors})
+        return self._reply(201, {"message": "All items in batch processed successfully.", "successCount": success_count,
+                                 "failureCount": 0, "totalItems": len(items)})
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_mock_server(base_latency_ms=MOCK_BASE_LATENCY_MS, per_item_latency_ms=MOCK_PER_ITEM_LATENCY_MS,
+                      item_failure_rate=MOCK_ITEM_FAILURE_RATE, error_rate=MOCK_ERROR_RATE, port=0, seed=1):
+    """Starts the mock functions server on a background thread and returns it."""
+    server = ThreadingHTTPServer(("localhost", port), MockFunctionsHandler)
+    server.daemon_threads = True
+    server.base_latency_ms = base_latency_ms
+    server.per_item_latency_ms = per_item_latency_ms
+    server.item_failure_rate = item_failure_rate
+    server.error_rate = error_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    reset_mock_server_counters(server)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def reset_mock_server_counters(server):
+    server.requests = {"patients": 0, "visits": 0}
+    server.items_accepted = {"patients": 0, "visits": 0}
+    server.unique_patients = set()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KB on Linux
+
+def run_import_mode(csv_path, port, mode_kwargs, work_dir, results, verbose=False):
+    """Child-process entry point: runs one import against the mock server and reports metrics."""
+    importer.CSV_FILE_PATH = csv_path
+    importer.TARGET_HOST = f"localhost:{port}"
+    importer.CONNECTION_TYPE = http.client.HTTPConnection
+    importer.CHECKPOINT_JOURNAL_PATH = os.path.join(work_dir, "import-journal.jsonl")
+    importer.DELTA_INDEX_PATH = os.path.join(work_dir, "import-index.sqlite")
+
+    metrics = importer.ImportMetrics()
+    started = time.perf_counter()
+    try:
+        if verbose:
+            importer.import_patients_and_visits(metrics=metrics, **mode_kwargs)
+        else:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                importer.import_patients_and_visits(metrics=metrics, **mode_kwargs)
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+        return
+    elapsed = time.perf_counter() - started
+    snapshot = metrics.snapshot()
+    send = snapshot["stages"]["send"]
+    results.put({"elapsed": elapsed, "batches": send["count"], "peak_rss_mb": peak_rss_mb(),
+                 "p50_ms": send["p50_ms"], "p99_ms": send["p99_ms"],
+                 "stage_seconds": {name: stage["total_seconds"] for name, stage in snapshot["stages"].items()},
+                 "counters": snapshot["counters"]})
+
+def run_benchmark(csv_path, rows, modes, server, verbose=False):
+    """Runs each import mode in its own process (so peak RSS is per mode) and returns a report."""
+    report = []
+    context = multiprocessing.get_context()
+    for mode in modes:
+        reset_mock_server_counters(server)
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = context.Queue()
+            process = context.Process(target=run_import_mode,
+                                      args=(csv_path, server.server_address[1], IMPORT_MODES[mode], work_dir, results, verbose))
+            process.start()
+            result = None
+            while result is None:
+                try:
+                    result = results.get(timeout=1.0)
+                except queue.Empty:
+                    if process.exitcode is not None:
+                        try: # A result put just before exiting may still be on its way
+                            result = results.get(timeout=1.0)
+                        except queue.Empty: # Died without reporting (e.g. killed)
+                            result = {"error": f"import process exited with code {process.exitcode}"}
+            process.join()
+        if "error" in result:
+            print(f"  {mode}: FAILED\n{result['error']}")
+            continue
+        result.update({
+            "mode": mode,
+            "rows_per_second": rows / result["elapsed"] if result["elapsed"] else 0.0,
+            "batches_per_second": result["batches"] / result["elapsed"] if result["elapsed"] else 0.0,
+            "patients_accepted": server.items_accepted["patients"],
+            "visits_accepted": server.items_accepted["visits"],
+        })
+        report.append(result)
+        print(f"  {mode}: {result['elapsed']:.1f} s")
+    return report
+
+def print_report(report, rows):
+    print(f"\n--- Import Benchmark ({rows} rows) ---")
+    print(f"{'mode':<16}{'seconds':>9}{'rows/s':>10}{'batches/s':>11}{'p50 ms':>9}{'p99 ms':>9}{'wire MB':>9}{'peak RSS MB':>13}{'patients':>10}{'visits':>9}")
+    for result in report:
+        print(f"{result['mode']:<16}{result['elapsed']:>9.1f}{result['rows_per_second']:>10.0f}{result['batches_per_second']:>11.1f}"
+              f"{result['p50_ms']:>9.0f}{result['p99_ms']:>9.0f}{result['counters'].get('request_bytes', 0) / (1024 * 1024):>9.2f}"
+              f"{result['peak_rss_mb']:>13.1f}"
+              f"{result['patients_accepted']:>10}{result['visits_accepted']:>9}")
+    stages = importer.ImportMetrics.STAGES
+    print("\nSeconds per stage (read/parse in worker CPU time for parallel-parse; send summed over requests):")
+    print(f"{'mode':<16}" + "".join(f"{stage:>14}" for stage in stages))
+    for result in report:
+        print(f"{result['mode']:<16}" + "".join(f"{result['stage_seconds'][stage]:>14.2f}" for stage in stages))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the clinic CSV importer against a local mock of the Cloud Functions.")
+    parser.add_argument("--rows", type=int, default=10_000, help="Rows in the synthetic CSV (default: 10000).")
+    parser.add_argument("--csv", default=None, help="Use (or create, if missing) this CSV instead of a temporary one.")
+    parser.add_argument("--modes", default="sequential,concurrent",
+                        help=f"Comma-separated import modes: {', '.join(IMPORT_MODES)} (default: sequential,concurrent).")
+    parser.add_argument("--latency-ms", type=float, default=MOCK_BASE_LATENCY_MS, help="Mock base latency per request.")
+    parser.add_argument("--per-item-latency-ms", type=float, default=MOCK_PER_ITEM_LATENCY_MS, help="Mock latency added per batch item.")
+    parser.add_argument("--item-failure-rate", type=float, default=MOCK_ITEM_FAILURE_RATE, help="Fraction of items failed in 207 responses.")
+    parser.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE, help="Fraction of requests answered with 503.")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file.")
+    parser.add_argument("--verbose", action="store_true", help="Show the importer's own output.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown_modes = [mode for mode in modes if mode not in IMPORT_MODES]
+    if unknown_modes:
+        sys.exit(f"Unknown modes: {', '.join(unknown_modes)}. Choose from: {', '.join(IMPORT_MODES)}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_path = args.csv or os.path.join(temp_dir, "synthetic_clinic.csv")
+        if os.path.exists(csv_path):
+            with open(csv_path, mode='r', encoding='utf-8-sig', newline='') as existing:
+                rows = sum(1 for _ in csv.reader(existing)) - 1
+            print(f"Using existing CSV {csv_path} ({rows} rows).")
+        else:
+            print(f"Generating synthetic clinic CSV with {args.rows} rows at {csv_path}...")
+            generation_started = time.perf_counter()
+            rows = generate_synthetic_clinic_csv(csv_path, args.rows)
+            print(f"  done in {time.perf_counter() - generation_started:.1f} s ({os.path.getsize(csv_path) / (1024 * 1024):.1f} MB)")
+
+        server = start_mock_server(args.latency_ms, args.per_item_latency_ms, args.item_failure_rate, args.error_rate)
+        print(f"Mock functions server listening on localhost:{server.server_address[1]}")
+        print("Running import modes...")
+        try:
+            report = run_benchmark(csv_path, rows, modes, server, verbose=args.verbose)
+        finally:
+            server.shutdown()
+
+    print_report(report, rows)
+    if args.json:
+        with open(args.json, mode='w', encoding='utf-8') as json_file:
+            json.dump({"rows": rows, "results": report}, json_file, indent=2)
+        print(f"\nReport written to {args.json}")
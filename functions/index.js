@@ -65,6 +65,76 @@ try {
     logger.error("Error loading or parsing medication_context_data.json:", {error: error.message});
 }
 
+// Returns the items array of a batch request from import_patients_from_csv.py.
+// Bodies with encoding "dict-v1" carry one row of values per item in the order of
+// `fields` (dotted paths); values of `stringFields` and of the objects listed in
+// `listFields` are indexes into `strings`. Plain bodies are returned as they are.
+// Only the fields the importer sends are accepted (the endpoints are public, so a
+// crafted path such as "__proto__.x" must never be written); anything else makes the
+// body invalid and undefined is returned.
+const IMPORT_BATCH_FIELDS = {
+    patients: new Set(["pReg", "name", "name_normalized", "ageLastRecorded", "ageUnitLastRecorded", "sex", "tToken",
+        "contactNo", "nicNo", "fatherName", "address", "dateOfRecording", "recordedByUserId", "isImported",
+        "updateExisting"]),
+    visits: new Set(["patientId", "visitData.visitDate", "visitData.complaints", "visitData.examination",
+        "visitData.diagnosis", "visitData.investigation", "visitData.advise", "visitData.nextPlan",
+        "visitData.amountCharged", "visitData.originalCsvDate", "visitData.medications"]),
+};
+const IMPORT_BATCH_LIST_FIELDS = {
+    "visitData.medications": new Set(["name", "instructions", "duration"]),
+};
+
+function decodeImportBatch(body, itemsKey) {
+    if (!body || body.encoding !== "dict-v1") {
+        return body ? body[itemsKey] : undefined;
+    }
+    const { fields, strings } = body;
+    const rows = body[itemsKey];
+    const knownFields = IMPORT_BATCH_FIELDS[itemsKey];
+    if (!Array.isArray(rows) || !Array.isArray(fields) || !Array.isArray(strings) || !knownFields) {
+        return undefined;
+    }
+    if (!fields.every((field) => typeof field === "string" && knownFields.has(field))) {
+        return undefined;
+    }
+    const stringFields = new Set((Array.isArray(body.stringFields) ? body.stringFields : [])
+        .filter((field) => typeof field === "string"));
+    const rawListFields = body.listFields && typeof body.listFields === "object" ? body.listFields : {};
+    const listFields = new Map();
+    for (const field of Object.keys(rawListFields)) { // Own keys only
+        const subfields = rawListFields[field];
+        const knownSubfields = IMPORT_BATCH_LIST_FIELDS[field];
+        if (!Object.hasOwn(IMPORT_BATCH_LIST_FIELDS, field) || !Array.isArray(subfields) ||
+            !subfields.every((subfield) => knownSubfields.has(subfield))) {
+            return undefined;
+        }
+        listFields.set(field, subfields);
+    }
+    const paths = fields.map((field) => field.split("."));
+
+    return rows.map((row) => {
+        const item = {};
+        fields.forEach((field, column) => {
+            let value = Array.isArray(row) ? row[column] : undefined;
+            if (listFields.has(field)) {
+                const subfields = listFields.get(field);
+                value = Array.isArray(value) ? value.map((entry) =>
+                    Object.fromEntries(subfields.map((subfield, i) => [subfield, strings[entry[i]]]))) : [];
+            } else if (stringFields.has(field)) {
+                value = strings[value];
+            }
+            const path = paths[column];
+            let target = item;
+            for (const part of path.slice(0, -1)) {
+                if (!Object.hasOwn(target, part)) target[part] = {};
+                target = target[part];
+            }
+            target[path[path.length - 1]] = value;
+        });
+        return item;
+    });
+}
+
 exports.processPatientAudio = onRequest(
     { 
         region: 'us-central1', 
@@ -442,7 +512,7 @@ exports.createPatientHttp = onRequest(
                 return res.status(405).send({ error: "Method Not Allowed" });
             }
 
-            const patientDataArray = req.body.patients;
+            const patientDataArray = decodeImportBatch(req.body, "patients");
             if (!patientDataArray || !Array.isArray(patientDataArray) || patientDataArray.length === 0) {
                 logger.warn("Bad Request: 'patients' array is required for createPatientHttp.");
                 return res.status(400).json({ error: "Request body must be a non-empty array of patient objects under the 'patients' key." });
@@ -470,9 +540,22 @@ exports.createPatientHttp = onRequest(
 
                     // For imported patients (script should always set isImported: true and provide pReg)
                     if (patientData.isImported === true) {
+                        // updateExisting: set by delta imports for patients whose CSV data changed since they were imported
+                        const { updateExisting, ...importedData } = patientData;
                         const patientDocRef = patientsCollection.doc(pRegFromData); // Use PReg from CSV as Document ID
                         const existingDoc = await patientDocRef.get();
 
+                        if (existingDoc.exists && updateExisting === true && existingDoc.data().isImported === true) {
+                            await patientDocRef.set({
+                                ...importedData,
+                                name_normalized: importedData.name ? importedData.name.trim().toLowerCase() : '',
+                                updatedAt: now
+                            }, { merge: true }); // Keeps createdAt and fields added in the app
+                            logger.info("Imported patient data updated in Firestore.", { documentId: patientDocRef.id, pReg: pRegFromData });
+                            successCount++;
+                            results.push({ pReg: pRegFromData, id: patientDocRef.id, status: "updated" });
+                            continue;
+                        }
                         if (existingDoc.exists) {
                             logger.info(`Patient with PReg (doc ID) ${pRegFromData} already exists. Skipping creation.`);
                             successCount++; // Count as success as it exists or was processed
@@ -481,7 +564,7 @@ exports.createPatientHttp = onRequest(
                         }
 
                         const dataToSet = {
-                            ...patientData,
+                            ...importedData,
                             name_normalized: patientData.name ? patientData.name.trim().toLowerCase() : '' ,
                             createdAt: patientData.createdAt || now, // Use provided or set new
                             updatedAt: now
@@ -906,6 +989,12 @@ exports.addHistoricalVisit = onRequest(
     }
 );
 
+// Document ID of an imported visit: "csv-" plus its original CSV date, with the characters
+// Firestore does not allow in IDs ("/" in DD/MM/YYYY) replaced.
+function historicalVisitDocId(originalCsvDate) {
+    return `csv-${String(originalCsvDate).replace(/[/\\]/g, "-")}`;
+}
+
 exports.addHistoricalVisitBatch = onRequest(
     { region: 'us-central1', timeoutSeconds: 540, memory: '1GB' }, // Increased timeout for larger batches
     async (req, res) => {
@@ -915,7 +1004,7 @@ exports.addHistoricalVisitBatch = onRequest(
                 return res.status(405).send({ error: "Method Not Allowed" });
             }
 
-            const { visits } = req.body; // Expects an array of { patientId, visitData }
+            const visits = decodeImportBatch(req.body, "visits"); // Expects an array of { patientId, visitData }
 
             if (!Array.isArray(visits) || visits.length === 0) {
                 logger.warn("Bad Request: Missing or empty visits array for batch", { body: req.body });
@@ -964,7 +1053,13 @@ exports.addHistoricalVisitBatch = onRequest(
                         createdAt: FieldValue.serverTimestamp(),
                     };
 
-                    const visitRef = await patientRef.collection("visits").add(visitPayload);
+                    // A visit with its original CSV date always goes to the same document, so a batch
+                    // the importer re-sends after a timeout overwrites its visits instead of adding them again.
+                    const visitsRef = patientRef.collection("visits");
+                    const visitRef = visitData.originalCsvDate
+                        ? visitsRef.doc(historicalVisitDocId(visitData.originalCsvDate))
+                        : visitsRef.doc();
+                    await visitRef.set(visitPayload);
                     results.push({ patientId, visitId: visitRef.id, visitDate: visitData.visitDate, status: "success" });
                     successCount++;
                 } catch (error) {
@@ -1,71 +1,339 @@
-import csv
+import argparse
+import hashlib
 import json
+import math
 import os
+import re
+from collections import Counter, defaultdict
+
+from indexed_csv import IndexedCSV
 
 # Define the input CSV file path and output JSON file path
 CSV_FILE_PATH = '/Users/areebbajwa/Downloads/ClinicData.xlsx - Sheet1.csv'
 # New output file for the three distinct lists
-JSON_OUTPUT_PATH = os.path.join('functions', 'medication_context_data.json') 
+JSON_OUTPUT_PATH = os.path.join('functions', 'medication_context_data.json')
+# Counts gathered so far, per CSV file, so later runs only read rows added since.
+# Kept outside functions/ so it is not deployed with the Cloud Functions.
+STATE_PATH = 'medication_context_state.json'
 
 # Column names in your CSV
 MEDICATION_COLUMN_NAME = 'MName'
 INSTRUCTIONS_COLUMN_NAME = 'DoseInstruc'
 DURATION_COLUMN_NAME = 'DoseforDay'
 
-def generate_medication_context_json():
-    unique_med_names = set()
-    unique_instructions = set()
-    unique_durations = set()
+# Keep only the most frequent entries of each list (None keeps everything).
+TOP_K = None
+# Also write "medicationDefaults": each medication's most common instruction and duration.
+INCLUDE_MEDICATION_DEFAULTS = False
+
+# Merge spelling variants of a medication name ("Tab Dioplus 5/80 mg", "tab dioplus 5/80mg")
+# into the most prescribed one and write the others to "medicationAliases".
+DEDUPE_MEDICATION_NAMES = True
+# Minimum Jaccard similarity of the names' character trigrams for two names to be variants.
+# Names whose strengths differ (5/80 vs 5/160) are never merged.
+MEDICATION_SIMILARITY_THRESHOLD = 0.8
+# Nor are names that differ in a release / strength marker or dosage form ("Glucophage" vs
+# "Glucophage XR", "Tab Ventolin" vs "Syp Ventolin"). Spellings of a form share its marker.
+MEDICATION_FORM_MARKERS = {
+    "xr": "xr", "er": "er", "sr": "sr", "cr": "cr", "la": "la", "mr": "mr", "dr": "dr", "xl": "xl",
+    "odt": "odt", "plus": "plus", "forte": "forte",
+    "tab": "tab", "tabs": "tab", "tablet": "tab", "tablets": "tab",
+    "cap": "cap", "caps": "cap", "capsule": "cap", "capsules": "cap",
+    "inj": "inj", "injection": "inj", "syp": "syp", "syr": "syp", "syrup": "syp",
+    "susp": "susp", "suspension": "susp", "drops": "drops", "oint": "oint", "ointment": "oint",
+    "cream": "cream", "gel": "gel", "inhaler": "inhaler", "sachet": "sachet", "supp": "supp",
+}
+
+DOSE_UNIT_SPACING = re.compile(r'(\d)\s+(mg|mcg|ug|g|ml|iu|%)(?![a-z])')
+NON_DECIMAL_DOT = re.compile(r'(?<!\d)\.|\.(?!\d)')
+NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+WORD_PATTERN = re.compile(r'[a-z]+')
+
+# Bytes just before a file's recorded offset that must be unchanged for it to count as
+# appended to rather than rewritten.
+FINGERPRINT_BYTES = 4096
+
+LIST_KEYS = ("medicationNames", "instructions", "durations")
+
+def empty_counts():
+    return {"medicationNames": Counter(), "instructions": Counter(), "durations": Counter(),
+            "pairs": {}} # medication name -> {"instructions": Counter, "durations": Counter}
 
+def file_fingerprint(reader, offset):
+    """Hash of the header plus the bytes just before offset of an open IndexedCSV."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(reader.fieldnames).encode('utf-8'))
+    if reader.mm is not None:
+        digest.update(reader.mm[max(reader.data_offset, offset - FINGERPRINT_BYTES):offset])
+    return digest.hexdigest()
+
+def load_state(state_path):
+    """Returns {csv path: source state} with Counters, or {} if there is no usable state."""
     try:
-        with open(CSV_FILE_PATH, mode='r', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            
-            required_columns = [MEDICATION_COLUMN_NAME, INSTRUCTIONS_COLUMN_NAME, DURATION_COLUMN_NAME]
-            for col in required_columns:
-                if col not in reader.fieldnames:
-                    print(f"Error: Column '{col}' not found in CSV header.")
-                    print(f"Available columns are: {reader.fieldnames}")
-                    return
-
-            for row in reader:
-                med_name = row[MEDICATION_COLUMN_NAME]
-                if med_name and med_name.strip():
-                    unique_med_names.add(med_name.strip())
-                
-                instructions = row[INSTRUCTIONS_COLUMN_NAME]
-                if instructions and instructions.strip():
-                    unique_instructions.add(instructions.strip())
-                
-                duration = row[DURATION_COLUMN_NAME]
-                if duration and duration.strip():
-                    unique_durations.add(duration.strip())
-        
-        if not unique_med_names and not unique_instructions and not unique_durations:
-            print("No relevant data (medication names, instructions, or durations) found or extracted from the CSV.")
-            return
+        with open(state_path, mode='r', encoding='utf-8') as statefile:
+            sources = json.load(statefile).get("sources", {})
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring unreadable state file {state_path}: {e}")
+        return {}
+    for source in sources.values():
+        counts = source["counts"]
+        for key in LIST_KEYS:
+            counts[key] = Counter(counts[key])
+        counts["pairs"] = {name: {"instructions": Counter(pair["instructions"]), "durations": Counter(pair["durations"])}
+                           for name, pair in counts["pairs"].items()}
+    return sources
+
+def save_state(state_path, sources):
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, mode='w', encoding='utf-8') as statefile:
+        json.dump({"sources": sources}, statefile, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, state_path)
+
+def count_rows(csv_path, source):
+    """Folds the rows of csv_path that source (its previous state, or None) has not seen
+    into a new source state. Returns (source state, rows read)."""
+    with IndexedCSV(csv_path) as reader:
+        fieldnames = reader.fieldnames or []
+        required_columns = [MEDICATION_COLUMN_NAME, INSTRUCTIONS_COLUMN_NAME, DURATION_COLUMN_NAME]
+        for col in required_columns:
+            if col not in fieldnames:
+                print(f"Error: Column '{col}' not found in CSV header of {csv_path}.")
+                print(f"Available columns are: {fieldnames}")
+                return None, 0
+
+        start_offset = reader.data_offset
+        if source is not None:
+            if source["size"] == reader.size and source["mtimeNs"] == reader.mtime_ns:
+                return source, 0 # Unchanged since the last run
+            if source["offset"] <= reader.size and source["fingerprint"] == file_fingerprint(reader, source["offset"]):
+                start_offset = source["offset"] # Rows were appended; count just those
+            else:
+                print(f"{csv_path} was rewritten since the last run; counting it again from the start.")
+                source = None
+        counts = source["counts"] if source is not None else empty_counts()
+
+        # Rows come from the memory-mapped file as lists; only these three positions are read.
+        name_position, instructions_position, duration_position = (reader.column(col) for col in required_columns)
+        width = max(name_position, instructions_position, duration_position) + 1
+        names, instructions_counts, durations_counts, pairs = (
+            counts["medicationNames"], counts["instructions"], counts["durations"], counts["pairs"])
+        rows_read = 0
+        for _, row in reader.iter_rows(start_offset):
+            rows_read += 1
+            if len(row) < width:
+                row = row + [''] * (width - len(row))
+            med_name = row[name_position].strip()
+            instructions = row[instructions_position].strip()
+            duration = row[duration_position].strip()
+            if med_name:
+                names[med_name] += 1
+            if instructions:
+                instructions_counts[instructions] += 1
+            if duration:
+                durations_counts[duration] += 1
+            if med_name and (instructions or duration):
+                pair = pairs.get(med_name)
+                if pair is None:
+                    pair = pairs[med_name] = {"instructions": Counter(), "durations": Counter()}
+                if instructions:
+                    pair["instructions"][instructions] += 1
+                if duration:
+                    pair["durations"][duration] += 1
+
+        return {"size": reader.size, "mtimeNs": reader.mtime_ns, "offset": reader.size,
+                "fingerprint": file_fingerprint(reader, reader.size), "counts": counts}, rows_read
+
+def ranked(counter, top_k=None):
+    """Entries by descending count (ties alphabetically), optionally only the first top_k."""
+    entries = sorted(counter.items(), key=lambda entry: (-entry[1], entry[0]))
+    return [value for value, _ in entries[:top_k]]
+
+def normalize_medication_name(name):
+    """Lower-cases, drops abbreviation dots and extra spaces, and writes doses as "80mg"."""
+    key = NON_DECIMAL_DOT.sub(' ', name.lower())
+    key = ' '.join(key.split())
+    return DOSE_UNIT_SPACING.sub(r'\1\2', key)
+
+def medication_form_markers(key):
+    """The release / strength markers and dosage forms among a normalized name's words."""
+    return frozenset(MEDICATION_FORM_MARKERS[word] for word in WORD_PATTERN.findall(key) if word in MEDICATION_FORM_MARKERS)
+
+def name_trigrams(key):
+    compact = f"#{key.replace(' ', '')}#"
+    return {compact[i:i + 3] for i in range(len(compact) - 2)}
+
+def cluster_medication_names(name_counts, threshold=MEDICATION_SIMILARITY_THRESHOLD):
+    """Groups spelling variants. Returns {name: canonical name} for every name in name_counts.
+
+    Names with the same normalized form are always variants. Normalized forms are then
+    visited from most to least prescribed; each joins the most similar cluster leader
+    (trigram Jaccard >= threshold, same strength numbers and form markers, see
+    MEDICATION_FORM_MARKERS) or becomes a leader itself,
+    so clusters cannot chain through a series of small differences.
 
-        print(f"Found {len(unique_med_names)} unique medication names.")
-        print(f"Found {len(unique_instructions)} unique instructions.")
-        print(f"Found {len(unique_durations)} unique durations.")
+    Candidate leaders come from an inverted index of trigrams with prefix filtering:
+    with trigrams ordered rarest first, two sets with Jaccard >= threshold must share
+    one of their first len - ceil(threshold * len) + 1 trigrams, so only those are
+    indexed and probed. That keeps the work close to linear in the number of names
+    instead of comparing every pair.
+    """
+    groups = defaultdict(list) # normalized form -> raw names
+    for name in name_counts:
+        groups[normalize_medication_name(name)].append(name)
+    group_counts = {key: sum(name_counts[name] for name in names) for key, names in groups.items()}
 
-        context_data = {
-            "medicationNames": sorted(list(unique_med_names)),
-            "instructions": sorted(list(unique_instructions)),
-            "durations": sorted(list(unique_durations))
+    trigrams = {key: name_trigrams(key) for key in groups}
+    numbers = {key: NUMBER_PATTERN.findall(key) for key in groups}
+    forms = {key: medication_form_markers(key) for key in groups}
+    trigram_frequency = Counter(trigram for key_trigrams in trigrams.values() for trigram in key_trigrams)
+
+    leader_of = {}
+    index = defaultdict(list) # trigram -> leaders having it in their prefix
+    for key in sorted(groups, key=lambda key: (-group_counts[key], key)):
+        key_trigrams = trigrams[key]
+        size = len(key_trigrams)
+        prefix = sorted(key_trigrams, key=lambda trigram: (trigram_frequency[trigram], trigram))[
+            :size - math.ceil(threshold * size - 1e-9) + 1]
+        best_leader, best_similarity = None, threshold
+        candidates = set()
+        for trigram in prefix:
+            candidates.update(index[trigram])
+        for leader in candidates:
+            leader_trigrams = trigrams[leader]
+            if numbers[leader] != numbers[key] or forms[leader] != forms[key] or \
+                    not threshold * size <= len(leader_trigrams) <= size / threshold:
+                continue
+            similarity = len(key_trigrams & leader_trigrams) / len(key_trigrams | leader_trigrams)
+            if similarity > best_similarity or (similarity == best_similarity and best_leader is None):
+                best_leader, best_similarity = leader, similarity
+        if best_leader is None:
+            leader_of[key] = key
+            for trigram in prefix:
+                index[trigram].append(key)
+        else:
+            leader_of[key] = best_leader
+
+    # The canonical spelling is the most prescribed raw name of the leader's group.
+    canonical = {key: min(names, key=lambda name: (-name_counts[name], name)) for key, names in groups.items()}
+    return {name: canonical[leader_of[key]] for key, names in groups.items() for name in names}
+
+def merge_medication_variants(totals, canonical_names):
+    """Folds the counts of variant names into their canonical name (in place)."""
+    names = Counter()
+    pairs = {}
+    for name, count in totals["medicationNames"].items():
+        names[canonical_names[name]] += count
+    for name, pair in totals["pairs"].items():
+        merged_pair = pairs.setdefault(canonical_names.get(name, name), {"instructions": Counter(), "durations": Counter()})
+        merged_pair["instructions"].update(pair["instructions"])
+        merged_pair["durations"].update(pair["durations"])
+    totals["medicationNames"], totals["pairs"] = names, pairs
+
+def build_context_data(sources, top_k=None, include_medication_defaults=False, dedupe=DEDUPE_MEDICATION_NAMES,
+                       similarity_threshold=MEDICATION_SIMILARITY_THRESHOLD):
+    """Merges the per-file counts into the lists processPatientAudio puts in its prompt.
+
+    With dedupe, medication names are the canonical spellings only and
+    "medicationAliases" maps every other spelling seen in the CSVs to its canonical one.
+    """
+    totals = empty_counts()
+    for source in sources.values():
+        counts = source["counts"]
+        for key in LIST_KEYS:
+            totals[key].update(counts[key])
+        for name, pair in counts["pairs"].items():
+            total_pair = totals["pairs"].setdefault(name, {"instructions": Counter(), "durations": Counter()})
+            total_pair["instructions"].update(pair["instructions"])
+            total_pair["durations"].update(pair["durations"])
+
+    aliases = {}
+    if dedupe:
+        canonical_names = cluster_medication_names(totals["medicationNames"], similarity_threshold)
+        aliases = {name: canonical for name, canonical in sorted(canonical_names.items()) if name != canonical}
+        merge_medication_variants(totals, canonical_names)
+
+    context_data = {key: ranked(totals[key], top_k) for key in LIST_KEYS}
+    if dedupe:
+        kept_names = set(context_data["medicationNames"])
+        context_data["medicationAliases"] = {name: canonical for name, canonical in aliases.items() if canonical in kept_names}
+    if include_medication_defaults:
+        context_data["medicationDefaults"] = {
+            name: {"instructions": next(iter(ranked(pair["instructions"], 1)), ""),
+                   "duration": next(iter(ranked(pair["durations"], 1)), "")}
+            for name, pair in ((name, totals["pairs"].get(name)) for name in context_data["medicationNames"]) if pair
         }
+    return context_data
+
+def generate_medication_context_json(csv_paths=None, state_path=STATE_PATH, rebuild=False, top_k=TOP_K,
+                                     include_medication_defaults=INCLUDE_MEDICATION_DEFAULTS, output_path=JSON_OUTPUT_PATH,
+                                     dedupe=DEDUPE_MEDICATION_NAMES, similarity_threshold=MEDICATION_SIMILARITY_THRESHOLD):
+    """Counts medication names, instructions and durations in the CSV exports and writes
+    them to output_path, most frequent first.
+
+    Counts are kept per file in state_path: a file that grew since the last run only has
+    its new rows read, a rewritten one is counted again, and files from earlier runs that
+    are not named now still contribute. rebuild=True starts from empty counts.
+
+    dedupe merges spelling variants of medication names (see cluster_medication_names).
+    """
+    csv_paths = csv_paths or [CSV_FILE_PATH]
+    sources = {} if rebuild or not state_path else load_state(state_path)
 
-        os.makedirs(os.path.dirname(JSON_OUTPUT_PATH), exist_ok=True)
+    try:
+        for csv_path in csv_paths:
+            source_key = os.path.abspath(csv_path)
+            source, rows_read = count_rows(csv_path, sources.get(source_key))
+            if source is None:
+                return
+            sources[source_key] = source
+            print(f"Read {rows_read} new rows from {csv_path}.")
+
+        context_data = build_context_data(sources, top_k, include_medication_defaults, dedupe, similarity_threshold)
+        if not any(context_data[key] for key in LIST_KEYS):
+            print("No relevant data (medication names, instructions, or durations) found or extracted from the CSV.")
+            return
+
+        merged_variants = len(context_data.get("medicationAliases", {}))
+        print(f"Found {len(context_data['medicationNames'])} medication names ({merged_variants} spelling variants merged).")
+        print(f"Found {len(context_data['instructions'])} instructions.")
+        print(f"Found {len(context_data['durations'])} durations.")
 
-        with open(JSON_OUTPUT_PATH, mode='w', encoding='utf-8') as jsonfile:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+        with open(output_path, mode='w', encoding='utf-8') as jsonfile:
             json.dump(context_data, jsonfile, indent=4, ensure_ascii=False)
-        
-        print(f"Successfully generated {JSON_OUTPUT_PATH} with extracted context data.")
 
-    except FileNotFoundError:
-        print(f"Error: CSV file not found at {CSV_FILE_PATH}")
+        if state_path:
+            save_state(state_path, sources)
+
+        print(f"Successfully generated {output_path} with extracted context data.")
+
+    except FileNotFoundError as e:
+        print(f"Error: CSV file not found at {e.filename}")
     except Exception as e:
         print(f"An error occurred: {e}")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate the medication context lists for processPatientAudio from clinic CSVs.")
+    parser.add_argument("csv_paths", nargs="*", metavar="CSV", help="CSV exports to count (default: CSV_FILE_PATH).")
+    parser.add_argument("--state", default=STATE_PATH,
+                        help=f"File with the counts of earlier runs, so only new rows are read (default: {STATE_PATH}).")
+    parser.add_argument("--rebuild", action="store_true", help="Ignore the saved counts and read every file from the start.")
+    parser.add_argument("--top-k", type=int, default=TOP_K,
+                        help="Keep only the K most frequent names, instructions and durations (default: all).")
+    parser.add_argument("--medication-defaults", action="store_true", default=INCLUDE_MEDICATION_DEFAULTS,
+                        help="Also write each medication's most common instruction and duration.")
+    parser.add_argument("--no-dedupe", action="store_true", help="Keep every spelling of a medication name as its own entry.")
+    parser.add_argument("--similarity-threshold", type=float, default=MEDICATION_SIMILARITY_THRESHOLD,
+                        help=f"Trigram similarity at which two medication names are variants (default: {MEDICATION_SIMILARITY_THRESHOLD}).")
+    parser.add_argument("--output", default=JSON_OUTPUT_PATH, help=f"Output JSON path (default: {JSON_OUTPUT_PATH}).")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    generate_medication_context_json() 
\ No newline at end of file
+    args = parse_args()
+    generate_medication_context_json(csv_paths=args.csv_paths or None, state_path=args.state, rebuild=args.rebuild,
+                                     top_k=args.top_k, include_medication_defaults=args.medication_defaults,
+                                     output_path=args.output, dedupe=not args.no_dedupe,
+                                     similarity_threshold=args.similarity_threshold)
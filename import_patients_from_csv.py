@@ -1,10 +1,31 @@
+import argparse
+import bisect
 import csv
+import gzip
+import hashlib
+import heapq
 import json
 import http.client
+import itertools
+import math
+import os
+import random
+import threading
 import time # For potential rate limiting
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import re # For extracting PReg number
+import sqlite3
+import sys
 from datetime import datetime # Added for date parsing
+from functools import lru_cache
+
+from indexed_csv import IndexedCSV
+
+try:
+    import orjson # Optional: several times faster than json.dumps for batch payloads
+except ImportError:
+    orjson = None
 
 CSV_FILE_PATH = "/Users/areebbajwa/Downloads/ClinicData.xlsx - Sheet1 (1).csv" # Updated CSV Path
 
@@ -38,12 +59,68 @@ ADD_HISTORICAL_VISIT_FUNCTION_PATH = get_full_path("/addHistoricalVisitBatch")
 SET_PATIENT_COUNTER_FUNCTION_PATH = get_full_path(SET_PATIENT_COUNTER_FUNCTION_BASE_PATH)
 
 
-BATCH_SIZE = 50
+BATCH_SIZE = 50 # Starting batch size; AdaptiveBatchSizer tunes it per endpoint from here
+
+# Upper bounds for adaptive batching. addHistoricalVisitBatch rejects more than 250 visits.
+PATIENT_BATCH_MAX_ITEMS = 250
+VISIT_BATCH_MAX_ITEMS = 250
+MAX_BATCH_BYTES = 1_000_000 # Serialized JSON body size cap per batch
+# Batches that take longer than this to come back are shrunk; much faster ones are grown.
+# Well under the 60 s client socket timeout and the functions' own timeouts.
+TARGET_BATCH_LATENCY_SECONDS = 20.0
+
+# Checkpoint journal (JSON lines) recording acknowledged batches and the CSV byte offset
+# before which everything has been acknowledged. None means "<CSV_FILE_PATH>.import-journal.jsonl".
+CHECKPOINT_JOURNAL_PATH = None
+
+# Delta mode: SQLite index of the payload hash last accepted by the server for each PReg and
+# each (PReg, Date) visit. It describes what the target holds, not one export, so a newer
+# export under another file name is compared against the same index. None means
+# "import-index.<TARGET_HOST>.sqlite" next to this script.
+DELTA_INDEX_PATH = None
+# Patient search index (see PatientSearchIndex) updated with every imported patient, or None.
+SEARCH_INDEX_PATH = None
+# The patient search index is rewritten at most this often while an import runs (and at the end).
+SEARCH_INDEX_SAVE_INTERVAL_SECONDS = 60.0
+# Number of batches allowed in flight at once. Each sender thread keeps its own keep-alive
+# connection; the CSV reader blocks when this many batches are outstanding.
+MAX_IN_FLIGHT_REQUESTS = 4
+# CSV files read at the same time when several files or a directory are imported together.
+# They share the MAX_IN_FLIGHT_REQUESTS slots.
+FILE_WORKERS = 4
+
+# Whole-batch failures are re-sent with capped exponential backoff and full jitter. Timeouts,
+# connection resets, 429 and 502-504 are retried up to RETRY_MAX_ATTEMPTS times. Other 5xx
+# batches are split in half after RETRY_SPLIT_AFTER_ATTEMPTS to isolate poison records,
+# and 400/413 batches are split straight away; a single item is retried up to RETRY_MAX_ATTEMPTS.
+# Batches failing with any other 4xx are given up without retrying or splitting.
+RETRY_MAX_ATTEMPTS = 6
+RETRY_SPLIT_AFTER_ATTEMPTS = 3
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+TRANSIENT_STATUSES = frozenset([None, 429, 502, 503, 504])
+# 4xx statuses after which a batch is split to isolate the failing records
+SPLIT_STATUSES = frozenset([400, 413])
+# Items reported as failed in a 207 are re-queued into later batches until they have been
+# attempted this many times; after that they stay in the checkpoint journal for --resume.
+ITEM_MAX_ATTEMPTS = 3
+
+# Wire format of batch bodies: "json" (compact JSON) or "dict" (dictionary-encoded by
+# encode_dictionary_batch(); the functions expand it with decodeImportBatch()).
+WIRE_FORMAT = "json"
+# Bodies of at least GZIP_MIN_BYTES are gzip-compressed and sent with Content-Encoding: gzip.
+GZIP_REQUEST_BODIES = True
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
 
 def send_batch_request(conn, host, path, payload_key, batch_data, headers):
     """Helper function to send a batch request and handle response."""
     json_payload = json.dumps({payload_key: batch_data})
-    # print(f"Sending batch of {len(batch_data)} to {path}. Payload size: {len(json_payload)} bytes")
+    return send_batch_body(conn, host, path, json_payload, headers)
+
+def send_batch_body(conn, host, path, json_payload, headers):
+    """Sends an already serialized batch body. Returns (status, body, conn)."""
+    # print(f"Sending batch to {path}. Payload size: {len(json_payload)} bytes")
     try:
         if conn is None:
             # Use CONNECTION_TYPE which is set based on USE_EMULATOR
@@ -97,302 +174,2406 @@ def update_pReg_counter_in_firestore(max_preg_number):
     finally:
         if conn: conn.close()
 
-def import_patients():
-    processed_pregs_for_demographics = set()
-    patients_processed_count = 0 # Counts PRegs sent for demographic creation/check
-    patients_successfully_created_or_existing = 0
-    overall_failed_patient_batches = 0
-    detailed_failures = []
-    max_preg_val_from_csv = 0 # To store the highest PReg number
-
-    print(f"Starting patient import from: {CSV_FILE_PATH}")
-    print(f"Targeting Patient Creation Cloud Function (batch) at: http{'s' if not USE_EMULATOR else ''}://{TARGET_HOST}{CREATE_PATIENT_FUNCTION_PATH}")
-    print(f"Using BATCH_SIZE: {BATCH_SIZE}")
-
-    patient_batch = []
-    conn = None
-    headers = {'Content-type': 'application/json'}
+# How many (PReg, Date) visit groups may be open at once while streaming the CSV.
+# Clinic exports list all medication rows of a visit together, so a group is complete
+# as soon as its key changes; the window only absorbs mildly interleaved exports.
+VISIT_GROUP_WINDOW = 64
+# A visit's rows that come back after the visit has left the window are skipped (sending
+# them would overwrite the visit with just those rows); the first few are printed.
+REAPPEARED_VISIT_WARNINGS = 10
 
-    try:
-        with open(CSV_FILE_PATH, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            if not reader.fieldnames: # Basic CSV check
-                print("Error: CSV file for patient import appears to be empty or header is missing.")
-                return
+PREG_NUMBER_PATTERN = re.compile(r"PR-(\d+)", re.IGNORECASE)
 
-            for row_index, row in enumerate(reader):
-                if ROW_LIMIT_FOR_TESTING and row_index >= ROW_LIMIT_FOR_TESTING:
-                    print(f"Reached testing row limit of {ROW_LIMIT_FOR_TESTING}. Stopping patient demographic import.")
-                    break
+# Rows are normalized in blocks of this many so the Date / tAmount / PReg columns can be
+# converted once per distinct value in the block.
+PARSE_BLOCK_ROWS = 4096
 
-                preg = row.get('PReg', '').strip()
-                if not preg:
-                    continue # Skip rows with no PReg
-                
-                # Extract numerical part of PReg for counter update
-                match = re.match(r"PR-(\d+)", preg, re.IGNORECASE)
-                if match:
-                    preg_num = int(match.group(1))
-                    if preg_num > max_preg_val_from_csv:
-                        max_preg_val_from_csv = preg_num
-                elif preg.isdigit(): # Handle cases like just "5786" if they exist and are valid for max count
-                    preg_num = int(preg)
-                    if preg_num > max_preg_val_from_csv:
-                         max_preg_val_from_csv = preg_num
-
-                # Process demographics only once per PReg
-                if preg in processed_pregs_for_demographics:
-                    continue
-                
-                patient_name = row.get('Name', '').strip()
-                if not patient_name:
-                    print(f"Skipping PReg {preg} (row {row_index + 2}) for demographic import due to missing Name.")
-                    continue
-
-                patient_data = {
-                    "pReg": preg,
-                    "name": patient_name,
-                    "name_normalized": patient_name.lower().strip(), 
-                    "ageLastRecorded": row.get('Age', '').strip(),
-                    "ageUnitLastRecorded": row.get('YMD', '').strip(),
-                    "sex": row.get('Sex', '').strip(),
-                    "tToken": row.get('TToken', '').strip(),
-                    "contactNo": row.get('ContNo', '').strip() if row.get('ContNo', 'NULL') != 'NULL' else '',
-                    "nicNo": row.get('NICno', '').strip() if row.get('NICno', 'NULL') != 'NULL' else '',
-                    "fatherName": row.get('FName', '').strip() if row.get('FName', 'NULL') != 'NULL' else '', # Occupation
-                    "address": row.get('Address', '').strip(),
-                    "dateOfRecording": row.get('Date', '').strip(),
-                    "recordedByUserId": row.get('UserID', '').strip(),
-                    "isImported": True
-                }
-                patient_batch.append(patient_data)
-                processed_pregs_for_demographics.add(preg)
-                patients_processed_count +=1
-
-                if len(patient_batch) >= BATCH_SIZE:
-                    print(f"Sending batch of {len(patient_batch)} patients (Total processed so far: {patients_processed_count})...")
-                    status, body, conn = send_batch_request(conn, TARGET_HOST, CREATE_PATIENT_FUNCTION_PATH, "patients", patient_batch, headers)
-                    if status == "CONN_REFUSED": return
-                    if status and (status == 201 or status == 207): # 201 all created, 207 mixed results
-                        try:
-                            response_data = json.loads(body)
-                            patients_successfully_created_or_existing += response_data.get("successCount", 0)
-                            if response_data.get("failureCount", 0) > 0:
-                                print(f"  Batch had {response_data.get('failureCount',0)} failures. Details: {response_data.get('errors', [])}")
-                                detailed_failures.extend(response_data.get('errors', []))
-                            # print(f"  Batch response: {response_data.get('message', '')}")
-                        except json.JSONDecodeError:
-                            print(f"  ERROR decoding batch response: {body}")
-                            overall_failed_patient_batches += 1
-                    elif status is not None:
-                        print(f"  ERROR in patient batch. Status: {status}, Response: {body}")
-                        overall_failed_patient_batches += 1
-                    patient_batch = [] # Reset batch
-                    if conn is None and status is not None and status != "CONN_REFUSED" : time.sleep(1) # If connection was reset, pause
-
-            # Send any remaining patients
-            if patient_batch:
-                print(f"Sending final batch of {len(patient_batch)} patients...")
-                status, body, conn = send_batch_request(conn, TARGET_HOST, CREATE_PATIENT_FUNCTION_PATH, "patients", patient_batch, headers)
-                if status == "CONN_REFUSED": return
-                if status and (status == 201 or status == 207):
-                    try:
-                        response_data = json.loads(body)
-                        patients_successfully_created_or_existing += response_data.get("successCount", 0)
-                        if response_data.get("failureCount", 0) > 0:
-                            print(f"  Final batch had {response_data.get('failureCount',0)} failures. Details: {response_data.get('errors', [])}")
-                            detailed_failures.extend(response_data.get('errors', []))
-                        # print(f"  Final batch response: {response_data.get('message', '')}")
-                    except json.JSONDecodeError:
-                        print(f"  ERROR decoding final batch response: {body}")
-                        overall_failed_patient_batches += 1
-                elif status is not None:
-                    print(f"  ERROR in final patient batch. Status: {status}, Response: {body}")
-                    overall_failed_patient_batches += 1
-
-    except FileNotFoundError:
-        print(f"FATAL Error: CSV file not found at {CSV_FILE_PATH}.")
-        return
-    except Exception as e:
-        print(f"An unexpected error occurred during patient import: {e}")
-    finally:
-        if conn: conn.close()
+@lru_cache(maxsize=65536)
+def extract_preg_number(preg):
+    """Returns the numerical part of a PReg ("PR-123" or "123"), or None."""
+    match = PREG_NUMBER_PATTERN.match(preg)
+    if match:
+        return int(match.group(1))
+    if preg.isdigit(): # Handle cases like just "5786" if they exist and are valid for max count
+        return int(preg)
+    return None
 
-    print(f"\n--- Patient Demographic Import Summary ---")
-    print(f"Total unique PRegs processed for demographics: {patients_processed_count}")
-    print(f"Successfully created or already existing in DB: {patients_successfully_created_or_existing}")
-    print(f"Total batches resulting in errors: {overall_failed_patient_batches}")
-    print(f"Total individual patient records reported as failed by server: {len(detailed_failures)}")
-    if detailed_failures:
-        print("Details of PRegs that failed server-side processing (first 10 shown):")
-        for failure in detailed_failures[:10]:
-            print(f"  - PReg: {failure.get('pReg', failure.get('data', {}).get('pReg', 'N/A'))}, Reason: {failure.get('error', 'Unknown')}")
-    
-    # After all patient demographics are processed, update the counter
-    if max_preg_val_from_csv > 0:
-        update_pReg_counter_in_firestore(max_preg_val_from_csv)
-    else:
-        print("\nNo valid PReg numbers found in CSV to update the counter.")
+# One normalized CSV row. Produced by parse_rows() either inline or in parse worker
+# processes, so it only holds plain picklable values; messages about unparseable dates
+# and amounts are printed by the main process when the row is actually used.
+ParsedRow = namedtuple("ParsedRow", [
+    "offset", "preg", "preg_number", "name", "age", "age_unit", "sex", "token", "contact_no", "nic_no",
+    "father_name", "address", "date", "user_id", "complaints", "examination", "diagnosis", "investigation",
+    "advise", "next_plan", "amount_text", "amount_charged", "amount_valid", "visit_date", "medication",
+])
 
-def import_historical_visits():
-    print("\n--- Starting Historical Visit Import ---BATCH MODE---")
-    print(f"Targeting Add Historical Visit Cloud Function (batch) at: http{'s' if not USE_EMULATOR else ''}://{TARGET_HOST}{ADD_HISTORICAL_VISIT_FUNCTION_PATH}")
-    print(f"Using BATCH_SIZE: {BATCH_SIZE}")
+def convert_column(values, converter):
+    """Converts a column of strings by calling converter once per distinct value."""
+    converted = {value: converter(value) for value in set(values)}
+    return [converted[value] for value in values]
 
-    visits_to_process_map = defaultdict(lambda: {"details": None, "medications": []})
-    all_csv_rows = []
-    try:
-        with open(CSV_FILE_PATH, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            if not reader.fieldnames: return
-            all_csv_rows = list(reader)
-            if ROW_LIMIT_FOR_TESTING:
-                print(f"Applying row limit: processing first {ROW_LIMIT_FOR_TESTING} rows of CSV for visits.")
-                all_csv_rows = all_csv_rows[:ROW_LIMIT_FOR_TESTING]
-    except FileNotFoundError:
-        print(f"FATAL Error: CSV file not found at {CSV_FILE_PATH} for visit import.")
-        # This part of the code seems to have a bug with undefined variables.
-        # It's inside an exception handler, so it might not be critical right now.
-        # print(f"Total visits processed: {total_visits_processed}, Batches sent: {batches_sent}")
-        # print(f"Success count: {total_success_count}, Failure count: {total_failure_count}")
-        return
-    except Exception as e: return print(f"Error reading CSV for visits: {e}")
+def parse_rows(block, fieldnames):
+    """Normalizes a block of (offset, row) pairs, each row being the list of fields in
+    fieldnames order. Rows without a PReg become None.
 
-    if not all_csv_rows: return print("No data rows found in CSV for visit import.")
+    The same few thousand DD/MM/YYYY dates, fee amounts and PRegs repeat across many rows,
+    so those columns are converted column-wise, once per distinct value in the block, on
+    top of the converters' own memoization across blocks.
+    """
+    width = len(fieldnames)
+    rows = [row if len(row) >= width else row + [''] * (width - len(row)) for _, row in block]
+    positions = {name: position for position, name in enumerate(fieldnames)}
 
-    for row in all_csv_rows:
-        preg = row.get('PReg', '').strip()
-        visit_date_str = row.get('Date', '').strip() # Original format DD/MM/YYYY
-        amount_charged_str = row.get('tAmount', '0').strip() # Get tAmount, default to '0'
+    def column(name):
+        position = positions.get(name)
+        if position is None:
+            return [''] * len(rows)
+        return [row[position].strip() for row in rows]
 
-        if not preg or not visit_date_str: continue
+    def nullable_column(name): # Export writes missing values as the literal NULL
+        position = positions.get(name)
+        if position is None:
+            return [''] * len(rows)
+        return [row[position].strip() if row[position] != 'NULL' else '' for row in rows]
 
-        # Parse date
-        parsed_date_iso = ""
-        try:
-            # Assuming date is DD/MM/YYYY. Convert to YYYY-MM-DD for Firestore.
-            dt_object = datetime.strptime(visit_date_str, '%d/%m/%Y')
-            parsed_date_iso = dt_object.strftime('%Y-%m-%d')
-        except ValueError:
-            print(f"CRITICAL: Could not parse date '{visit_date_str}' for PReg {preg}. SKIPPING this visit record entirely.")
-            # Skip this entire record by continuing to the next loop iteration
+    pregs = column('PReg')
+    dates = column('Date') # Original format DD/MM/YYYY
+    amount_texts = column('tAmount')
+    preg_numbers = convert_column(pregs, extract_preg_number)
+    visit_dates = convert_column(dates, convert_visit_date)
+    amounts = convert_column(amount_texts, convert_amount)
+
+    parsed_rows = []
+    for (row_offset, _), preg, preg_number, visit_date_str, visit_date, amount_charged_str, (amount_charged, amount_valid), \
+            name, age, age_unit, sex, token, contact_no, nic_no, father_name, address, user_id, complaints, examination, \
+            diagnosis, investigation, advise, next_plan, med_name, dose_instructions, dose_days in zip(
+            block, pregs, preg_numbers, dates, visit_dates, amount_texts, amounts,
+            column('Name'), column('Age'), column('YMD'), column('Sex'), column('TToken'), nullable_column('ContNo'),
+            nullable_column('NICno'), nullable_column('FName'), column('Address'), column('UserID'), column('Complain'),
+            column('Examination'), column('Diagnose'), column('Investigation'), column('Advise'), column('NextPlan'),
+            column('MName'), column('DoseInstruc'), column('DoseforDay')):
+        if not preg:
+            parsed_rows.append(None)
             continue
+        parsed_rows.append(ParsedRow(
+            offset=row_offset,
+            preg=preg,
+            preg_number=preg_number,
+            name=name,
+            age=age,
+            age_unit=age_unit,
+            sex=sex,
+            token=token,
+            contact_no=contact_no,
+            nic_no=nic_no,
+            father_name=father_name, # Occupation
+            address=address,
+            date=visit_date_str,
+            user_id=user_id,
+            complaints=complaints,
+            examination=examination,
+            diagnosis=diagnosis,
+            investigation=investigation,
+            advise=advise,
+            next_plan=next_plan,
+            amount_text=amount_charged_str,
+            amount_charged=amount_charged,
+            amount_valid=amount_valid,
+            visit_date=visit_date,
+            medication=(med_name, dose_instructions, dose_days) if med_name else None,
+        ))
+    return parsed_rows
 
-        # Parse amount_charged
-        amount_charged = 0
-        if amount_charged_str:
-            try:
-                # Handle potential commas in thousands, e.g., "2,000" -> 2000
-                amount_charged = int(float(amount_charged_str.replace(',', '')))
-            except ValueError:
-                print(f"Warning: Could not parse tAmount '{amount_charged_str}' for PReg {preg}, visit date {visit_date_str}. Using 0.")
-                amount_charged = 0
-        
-        # Use original visit_date_str for visit_key to maintain uniqueness if multiple entries exist for same actual date before parsing
-        visit_key = (preg, visit_date_str) 
-
-        if visits_to_process_map[visit_key]["details"] is None:
-            visits_to_process_map[visit_key]["details"] = {
-                "visitDate": parsed_date_iso, # Store parsed date
-                "complaints": row.get('Complain', '').strip(),
-                "examination": row.get('Examination', '').strip(),
-                "diagnosis": row.get('Diagnose', '').strip(),
-                "investigation": row.get('Investigation', '').strip(),
-                "advise": row.get('Advise', '').strip(),
-                "nextPlan": row.get('NextPlan', '').strip(),
-                "amountCharged": amount_charged, # Add amount charged
-                "originalCsvDate": visit_date_str # Keep original date for reference if needed
-            }
-        med_name = row.get('MName', '').strip()
-        if med_name: 
-            visits_to_process_map[visit_key]["medications"].append({
-                "name": med_name,
-                "instructions": row.get('DoseInstruc', '').strip(),
-                "duration": row.get('DoseforDay', '').strip()
-            })
-
-    print(f"Identified {len(visits_to_process_map)} unique historical visits to prepare for batching.")
-    
-    visit_batch = []
-    total_visits_processed_in_batches = 0
-    total_visits_successfully_imported = 0
-    overall_failed_visit_batches = 0
-    detailed_visit_failures = []
-    conn = None
-    headers = {'Content-type': 'application/json'}
+def iter_parsed_rows(reader, block_rows=PARSE_BLOCK_ROWS, metrics=None, rows=None):
+    """Yields ParsedRows (None for rows without a PReg) from an IndexedCSV or OffsetCSVReader,
+    block by block. rows overrides which of the reader's (offset, row) pairs are parsed."""
+    metrics = metrics or DISABLED_METRICS
+    read_stage, parse_stage = metrics.stage("read"), metrics.stage("parse")
+    rows = iter(reader) if rows is None else rows
+    while True:
+        block_bytes_read = reader.bytes_read
+        read_started = time.perf_counter()
+        block = list(itertools.islice(rows, block_rows))
+        if not block:
+            return
+        parse_started = time.perf_counter()
+        read_stage.observe(parse_started - read_started, len(block))
+        metrics.increment("rows_read", len(block))
+        metrics.increment("csv_bytes_read", reader.bytes_read - block_bytes_read)
+        parsed_rows = parse_rows(block, reader.fieldnames)
+        parse_stage.observe(time.perf_counter() - parse_started, len(block))
+        yield from parsed_rows
+
+def build_patient_payload(parsed):
+    """Builds the createPatientHttp payload for the first CSV row seen for a PReg."""
+    return {
+        "pReg": parsed.preg,
+        "name": parsed.name,
+        "name_normalized": parsed.name.lower().strip(), 
+        "ageLastRecorded": parsed.age,
+        "ageUnitLastRecorded": parsed.age_unit,
+        "sex": parsed.sex,
+        "tToken": parsed.token,
+        "contactNo": parsed.contact_no,
+        "nicNo": parsed.nic_no,
+        "fatherName": parsed.father_name, # Occupation
+        "address": parsed.address,
+        "dateOfRecording": parsed.date,
+        "recordedByUserId": parsed.user_id,
+        "isImported": True
+    }
+
+@lru_cache(maxsize=65536)
+def convert_visit_date(visit_date_str):
+    """Converts DD/MM/YYYY to YYYY-MM-DD for Firestore. Returns None if unparseable."""
+    try:
+        dt_object = datetime.strptime(visit_date_str, '%d/%m/%Y')
+        return dt_object.strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=65536)
+def convert_amount(amount_charged_str):
+    """Parses tAmount ("2,000" -> 2000). Returns (amount, valid); invalid amounts are 0."""
+    if not amount_charged_str:
+        return 0, True
+    try:
+        # Handle potential commas in thousands, e.g., "2,000" -> 2000
+        return int(float(amount_charged_str.replace(',', ''))), True
+    except ValueError:
+        return 0, False
+
+def intern_medication(medication):
+    """Interns a (name, instructions, duration) tuple.
+
+    Medication names, instructions and durations come from a small vocabulary (a few
+    hundred names, a few dozen instructions/durations), so interning makes every
+    occurrence share one string object.
+    """
+    name, instructions, duration = medication
+    return (sys.intern(name), sys.intern(instructions), sys.intern(duration))
+
+class VisitRecord:
+    """Compact form of one historical visit while it is grouped, batched and in flight.
+
+    Uses __slots__ and keeps medications as interned tuples; the addHistoricalVisitBatch
+    payload dict is only built by to_payload() when the visit is serialized (and for
+    the rare failed item written to the checkpoint journal).
+    """
+
+    __slots__ = ("preg", "csv_date", "visit_date", "complaints", "examination", "diagnosis",
+                 "investigation", "advise", "next_plan", "amount_charged", "medications", "first_offset")
 
-    for (preg, visit_date_str), visit_data_parts in visits_to_process_map.items():
-        if visit_data_parts["details"] is None: continue
-        full_visit_data_for_payload = {
-            "patientId": preg, # This is the PReg
+    def __init__(self, preg, csv_date, visit_date, complaints, examination, diagnosis, investigation,
+                 advise, next_plan, amount_charged, medications=None, first_offset=None):
+        self.preg = preg
+        self.csv_date = csv_date # Original DD/MM/YYYY string, part of the visit key
+        self.visit_date = visit_date # YYYY-MM-DD
+        self.complaints = complaints
+        self.examination = examination
+        self.diagnosis = diagnosis
+        self.investigation = investigation
+        self.advise = advise
+        self.next_plan = next_plan
+        self.amount_charged = amount_charged
+        self.medications = medications if medications is not None else []
+        self.first_offset = first_offset
+
+    @classmethod
+    def from_parsed(cls, parsed):
+        """Builds a visit from the first CSV row of its group. Returns None if the date is unusable."""
+        if parsed.visit_date is None:
+            print(f"CRITICAL: Could not parse date '{parsed.date}' for PReg {parsed.preg}. SKIPPING this visit record entirely.")
+            return None
+        return cls(parsed.preg, sys.intern(parsed.date), sys.intern(parsed.visit_date),
+                   parsed.complaints, parsed.examination, parsed.diagnosis, parsed.investigation,
+                   parsed.advise, parsed.next_plan, parsed.amount_charged, first_offset=parsed.offset)
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Rebuilds a visit from an addHistoricalVisitBatch payload (e.g. a journal entry)."""
+        visit_data = payload["visitData"]
+        medications = [intern_medication((med.get("name", ""), med.get("instructions", ""), med.get("duration", "")))
+                       for med in visit_data.get("medications", [])]
+        return cls(payload["patientId"], visit_data["originalCsvDate"], visit_data["visitDate"],
+                   visit_data.get("complaints", ""), visit_data.get("examination", ""), visit_data.get("diagnosis", ""),
+                   visit_data.get("investigation", ""), visit_data.get("advise", ""), visit_data.get("nextPlan", ""),
+                   visit_data.get("amountCharged", 0), medications)
+
+    @property
+    def key(self):
+        return (self.preg, self.csv_date)
+
+    def to_payload(self):
+        # Key order matches the original payload so content hashes stay stable.
+        return {
+            "patientId": self.preg, # This is the PReg
             "visitData": {
-                **visit_data_parts["details"],
-                "medications": visit_data_parts["medications"]
+                "visitDate": self.visit_date, # Store parsed date
+                "complaints": self.complaints,
+                "examination": self.examination,
+                "diagnosis": self.diagnosis,
+                "investigation": self.investigation,
+                "advise": self.advise,
+                "nextPlan": self.next_plan,
+                "amountCharged": self.amount_charged, # Add amount charged
+                "originalCsvDate": self.csv_date, # Keep original date for reference if needed
+                "medications": [{"name": name, "instructions": instructions, "duration": duration}
+                                for name, instructions, duration in self.medications]
             }
         }
-        visit_batch.append(full_visit_data_for_payload)
-        total_visits_processed_in_batches +=1
-
-        if len(visit_batch) >= BATCH_SIZE:
-            print(f"Sending batch of {len(visit_batch)} visits (Total visits processed so far: {total_visits_processed_in_batches})...")
-            status, body, conn = send_batch_request(conn, TARGET_HOST, ADD_HISTORICAL_VISIT_FUNCTION_PATH, "visits", visit_batch, headers)
-            if status == "CONN_REFUSED": return
-            if status and (status == 201 or status == 207):
+
+class VisitGrouper:
+    """Groups streamed CSV rows into visits keyed by (PReg, original Date string).
+
+    The first row of a group supplies the visit details (first-row-wins) and every row
+    with an MName contributes a medication. A group is emitted once it falls out of the
+    window of open groups, so the open visits are bounded by VISIT_GROUP_WINDOW, not
+    file size. Completed visits are returned as VisitRecords, oldest first.
+
+    Rows whose key was already emitted (further apart in the file than the window) are
+    counted in reappeared_rows and skipped rather than sent as a second, partial visit.
+    For that the hash of every emitted key is kept (about 60 bytes per visit). With
+    preg_end_offset (the offset where a PReg's last rows end, from the CSV's row index)
+    a PReg's hashes are dropped once the reader has passed its last row, so only the
+    PRegs still to come in the file cost memory.
+    """
+
+    def __init__(self, window=VISIT_GROUP_WINDOW, preg_end_offset=None):
+        self.window = max(1, window)
+        self.open_groups = OrderedDict() # (PReg, Date) -> VisitRecord
+        self.preg_end_offset = preg_end_offset
+        self.emitted_keys = set() # hash((PReg, Date)) of emitted visits
+        self.expiring_keys = [] # heap of (offset after the PReg's last row, key hash)
+        self.unique_visits = 0
+        self.reappeared_keys = set()
+        self.reappeared_rows = 0
+
+    def add_row(self, parsed):
+        """Adds a ParsedRow with a Date and returns the list of VisitRecords completed by it."""
+        visit_key = (parsed.preg, parsed.date)
+        expiring_keys = self.expiring_keys
+        while expiring_keys and expiring_keys[0][0] <= parsed.offset:
+            self.emitted_keys.discard(heapq.heappop(expiring_keys)[1])
+        visit = self.open_groups.get(visit_key)
+        if visit is None:
+            if hash(visit_key) in self.emitted_keys:
+                self.reappeared_rows += 1
+                if visit_key not in self.reappeared_keys:
+                    self.reappeared_keys.add(visit_key)
+                    if len(self.reappeared_keys) <= REAPPEARED_VISIT_WARNINGS:
+                        print(f"Warning: Skipping a row of PReg {parsed.preg}, Date {parsed.date} at byte offset {parsed.offset}: "
+                              f"the visit was already sent (its rows are more than {self.window} visits apart).")
+                return []
+            visit = VisitRecord.from_parsed(parsed)
+            if visit is None:
+                return []
+            self.open_groups[visit_key] = visit
+            self.unique_visits += 1
+        else:
+            self.open_groups.move_to_end(visit_key)
+
+        if parsed.medication:
+            visit.medications.append(intern_medication(parsed.medication))
+
+        completed = []
+        while len(self.open_groups) > self.window:
+            visit_key, visit = self.open_groups.popitem(last=False)
+            self.remember_emitted(visit_key)
+            completed.append(visit)
+        return completed
+
+    def remember_emitted(self, visit_key):
+        key_hash = hash(visit_key)
+        self.emitted_keys.add(key_hash)
+        end_offset = self.preg_end_offset(visit_key[0]) if self.preg_end_offset is not None else None
+        if end_offset is not None:
+            heapq.heappush(self.expiring_keys, (end_offset, key_hash))
+
+    def flush(self):
+        """Returns all still-open visits, oldest first."""
+        completed = list(self.open_groups.values())
+        for visit_key in self.open_groups:
+            self.remember_emitted(visit_key)
+        self.open_groups.clear()
+        return completed
+
+    def min_open_offset(self):
+        """Offset of the earliest row still held in an open group, or None."""
+        offsets = [visit.first_offset for visit in self.open_groups.values() if visit.first_offset is not None]
+        return min(offsets) if offsets else None
+
+class AdaptiveBatchSizer:
+    """Picks the item count for the next batch of one endpoint.
+
+    The size grows additively while batches come back well under
+    TARGET_BATCH_LATENCY_SECONDS and shrinks when they are slow, time out, fail with
+    5xx/400, or return partial failures (207). Byte size is capped separately by
+    PendingBatch so large visit payloads never produce oversized requests.
+    """
+
+    def __init__(self, initial_size=BATCH_SIZE, max_items=VISIT_BATCH_MAX_ITEMS, max_bytes=MAX_BATCH_BYTES,
+                 target_latency=TARGET_BATCH_LATENCY_SECONDS, min_size=1):
+        self.min_size = min_size
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.current_size = max(min_size, min(initial_size, max_items))
+        self.lock = threading.Lock()
+
+    def record(self, status, elapsed_seconds, item_count):
+        """Adjusts the batch size from the outcome of a batch of item_count items."""
+        with self.lock:
+            size = self.current_size
+            if status is None or status == 400 or status == 413 or (isinstance(status, int) and status >= 500):
+                size = size // 2 # Timeout, connection reset, rejected or server error: back off hard
+            elif status == 207:
+                size = size - max(1, size // 4)
+            elif elapsed_seconds > self.target_latency and item_count * 2 >= size:
+                # Scale towards the size that would have hit the target latency
+                size = int(item_count * self.target_latency / elapsed_seconds)
+            elif elapsed_seconds > self.target_latency:
+                # A much smaller batch (split half, re-queued items) says little about how a
+                # full one scales, so only back off a step
+                size = size - max(1, size // 4)
+            elif elapsed_seconds < self.target_latency / 2 and item_count >= size:
+                size = size + max(1, size // 10)
+            self.current_size = max(self.min_size, min(size, self.max_items))
+
+def serialize_payload(payload):
+    """Compact UTF-8 JSON bytes of a payload, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def flatten_payload(payload, prefix=""):
+    """Returns [(dotted field path, value)] for a payload; nested dicts are flattened."""
+    flattened = []
+    for key, value in payload.items():
+        if isinstance(value, dict):
+            flattened.extend(flatten_payload(value, f"{prefix}{key}."))
+        else:
+            flattened.append((prefix + key, value))
+    return flattened
+
+def encode_dictionary_batch(payload_key, payloads):
+    """Serializes a batch body in the "dict-v1" encoding, or returns None if the payloads differ in shape.
+
+    Each item becomes a row of values in the order of "fields" (dotted paths into the
+    original object). Values of "stringFields", and of the objects in each "listFields"
+    entry (e.g. medications), are indexes into "strings", which holds every distinct
+    string of the batch once; keys, medication names, instructions and dates repeated
+    across visits are therefore sent once per batch.
+    """
+    rows = [flatten_payload(payload) for payload in payloads]
+    fields = [field for field, _ in rows[0]]
+    if any(len(row) != len(fields) or any(field != expected for (field, _), expected in zip(row, fields)) for row in rows):
+        return None
+
+    string_fields = []
+    list_fields = {}
+    for column, field in enumerate(fields):
+        values = [row[column][1] for row in rows]
+        if all(isinstance(value, str) for value in values):
+            string_fields.append(field)
+        elif all(isinstance(value, list) for value in values):
+            entries = [entry for value in values for entry in value]
+            if not entries:
+                continue # Empty everywhere: sent as is
+            if not all(isinstance(entry, dict) and all(isinstance(v, str) for v in entry.values()) for entry in entries):
+                return None
+            subfields = list(entries[0])
+            if any(list(entry) != subfields for entry in entries):
+                return None
+            list_fields[field] = subfields
+
+    strings = {}
+    string_columns = set(string_fields)
+    encoded_rows = []
+    for row in rows:
+        encoded_row = []
+        for field, value in row:
+            if field in string_columns:
+                encoded_row.append(strings.setdefault(value, len(strings)))
+            elif field in list_fields:
+                encoded_row.append([[strings.setdefault(entry[subfield], len(strings)) for subfield in list_fields[field]]
+                                    for entry in value])
+            else:
+                encoded_row.append(value)
+        encoded_rows.append(encoded_row)
+    return serialize_payload({"encoding": "dict-v1", "fields": fields, "stringFields": string_fields,
+                              "listFields": list_fields, "strings": list(strings), payload_key: encoded_rows})
+
+class PendingBatch:
+    """Items waiting to be sent to one endpoint, serialized once as they are added."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, payload_key):
+        self.batch_id = next(PendingBatch._ids)
+        self.payload_key = payload_key
+        self.items = []
+        self.serialized_items = []
+        self.offsets = [] # Source CSV offset of each item (None for retried journal items)
+        self.attempts = [] # Earlier attempts of each item that the server reported as failed
+        self.byte_count = 0
+        # CSV byte offsets of the rows the items came from (None for retried journal items)
+        self.min_offset = None
+        self.max_offset = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def would_overflow(self, serialized_item, max_bytes):
+        return bool(self.items) and self.byte_count + len(serialized_item) + 1 > max_bytes
+
+    def add(self, item, serialized_item, source_offset=None, attempts=0):
+        self.items.append(item)
+        self.serialized_items.append(serialized_item)
+        self.offsets.append(source_offset)
+        self.attempts.append(attempts)
+        self.byte_count += len(serialized_item) + 1 # + separator
+        if source_offset is not None:
+            if self.min_offset is None or source_offset < self.min_offset:
+                self.min_offset = source_offset
+            if self.max_offset is None or source_offset > self.max_offset:
+                self.max_offset = source_offset
+
+    def body(self):
+        return b'{"' + self.payload_key.encode('ascii') + b'":[' + b",".join(self.serialized_items) + b"]}"
+
+    def split(self):
+        """Returns two new batches with the first and second half of the items."""
+        middle = len(self.items) // 2
+        halves = []
+        for start, end in ((0, middle), (middle, len(self.items))):
+            half = PendingBatch(self.payload_key)
+            for position in range(start, end):
+                half.add(self.items[position], self.serialized_items[position], self.offsets[position], self.attempts[position])
+            halves.append(half)
+        return halves
+
+class BatchStats:
+    """Running totals for one endpoint (patients or visits)."""
+
+    def __init__(self):
+        self.items_sent = 0
+        self.success_count = 0
+        self.failed_batches = 0
+        self.failure_reports = 0 # Item failures reported by the server, over every attempt
+        self.detailed_failures = [] # Server errors of the items given up after their last attempt
+        self.batch_retries = 0 # Whole-batch re-sends after errors
+        self.batches_split = 0
+        self.items_requeued = 0 # Items re-queued after the server reported them as failed
+        self.items_given_up = 0 # Items left in the journal after their last attempt
+
+def record_batch_response(stats, status, body, label):
+    """Folds a createPatientHttp / addHistoricalVisitBatch response into stats.
+
+    Returns the decoded response for 201/207, or None if the batch as a whole failed.
+    """
+    if status and (status == 201 or status == 207): # 201 all created, 207 mixed results
+        try:
+            response_data = json.loads(body)
+            stats.success_count += response_data.get("successCount", 0)
+            if response_data.get("failureCount", 0) > 0:
+                print(f"  {label} had {response_data.get('failureCount',0)} failures. Details: {response_data.get('errors', [])}")
+                stats.failure_reports += response_data.get("failureCount", 0)
+            return response_data
+        except json.JSONDecodeError:
+            print(f"  ERROR decoding {label.lower()} response: {body}")
+            stats.failed_batches += 1
+    elif status is not None:
+        print(f"  ERROR in {label.lower()}. Status: {status}, Response: {body}")
+        stats.failed_batches += 1
+    else:
+        stats.failed_batches += 1 # Connection reset or timeout, already printed by send_batch_body
+    return None
+
+def item_key(payload_key, item):
+    """Journal key of a batch item: the PReg for patients, [PReg, original CSV date] for visits."""
+    if payload_key == "patients":
+        return item["pReg"]
+    return [item.preg, item.csv_date]
+
+def item_payload(payload_key, item):
+    """The request payload of a batch item (patients are kept as payload dicts already)."""
+    if payload_key == "patients":
+        return item
+    return item.to_payload()
+
+def failure_details(payload_key, items, response_data):
+    """The server's error entries for the given failed batch items."""
+    if response_data is None:
+        return []
+    if payload_key == "patients":
+        pregs = {item["pReg"] for item in items}
+        return [error for error in response_data.get("errors", []) if error.get("pReg") in pregs]
+    keys = {(item.preg, item.visit_date) for item in items}
+    return [error for error in response_data.get("errors", []) if (error.get("patientId"), error.get("visitDate")) in keys]
+
+def split_batch_outcome(payload_key, items, response_data):
+    """Splits batch items into (succeeded keys, positions of failed items) using the server's errors array."""
+    if response_data is None:
+        return [], list(range(len(items)))
+    errors = response_data.get("errors", []) if response_data.get("failureCount", 0) > 0 else []
+    if payload_key == "patients":
+        failed_pregs = {error.get("pReg") for error in errors}
+        failed = [position for position, item in enumerate(items) if item["pReg"] in failed_pregs]
+    else:
+        # Visit errors carry patientId and the ISO visitDate; consume each error once.
+        remaining = defaultdict(int)
+        for error in errors:
+            remaining[(error.get("patientId"), error.get("visitDate"))] += 1
+        failed = []
+        for position, item in enumerate(items):
+            key = (item.preg, item.visit_date)
+            if remaining[key] > 0:
+                remaining[key] -= 1
+                failed.append(position)
+    failed_positions = set(failed)
+    succeeded = [item_key(payload_key, item) for position, item in enumerate(items) if position not in failed_positions]
+    return succeeded, failed
+
+# Stage latency histograms use geometric buckets, four per doubling, from 10 µs to about 10 minutes.
+METRICS_HISTOGRAM_BOUNDS = tuple(0.00001 * 2 ** (i / 4) for i in range(104))
+# Seconds between the JSON lines written to --metrics-file while an import runs.
+METRICS_REPORT_INTERVAL_SECONDS = 10.0
+
+class StageMetrics:
+    """Observation count, item count, total time and latency histogram of one import stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.items = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(METRICS_HISTOGRAM_BOUNDS) + 1) # Last bucket: above the largest bound
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, items=1):
+        bucket = bisect.bisect_left(METRICS_HISTOGRAM_BOUNDS, seconds)
+        with self.lock:
+            self.count += 1
+            self.items += items
+            self.total_seconds += seconds
+            if seconds > self.max_seconds:
+                self.max_seconds = seconds
+            self.buckets[bucket] += 1
+
+    def percentile(self, fraction):
+        """Estimates a latency percentile in seconds, interpolating geometrically within a bucket."""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            if not bucket_count or seen + bucket_count < target:
+                seen += bucket_count
+                continue
+            lower = METRICS_HISTOGRAM_BOUNDS[bucket - 1] if bucket > 0 else METRICS_HISTOGRAM_BOUNDS[0] / 2
+            upper = METRICS_HISTOGRAM_BOUNDS[bucket] if bucket < len(METRICS_HISTOGRAM_BOUNDS) else self.max_seconds
+            upper = min(upper, self.max_seconds)
+            if upper <= lower:
+                return upper
+            return lower * (upper / lower) ** ((target - seen) / bucket_count)
+        return self.max_seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "items": self.items,
+                "total_seconds": round(self.total_seconds, 6),
+                "mean_ms": round(self.total_seconds / self.count * 1000, 3) if self.count else 0.0,
+                "p50_ms": round(self.percentile(0.50) * 1000, 3),
+                "p90_ms": round(self.percentile(0.90) * 1000, 3),
+                "p99_ms": round(self.percentile(0.99) * 1000, 3),
+                "max_ms": round(self.max_seconds * 1000, 3),
+                # [upper bound in ms (None above the last bound), observations] for non-empty buckets
+                "histogram": [[round(METRICS_HISTOGRAM_BOUNDS[bucket] * 1000, 4) if bucket < len(METRICS_HISTOGRAM_BOUNDS) else None,
+                               bucket_count] for bucket, bucket_count in enumerate(self.buckets) if bucket_count],
+            }
+
+class NullStageMetrics:
+    """Stand-in handed out by a disabled ImportMetrics; observing costs one method call."""
+
+    def observe(self, seconds, items=1):
+        pass
+
+NULL_STAGE_METRICS = NullStageMetrics()
+
+class ImportMetrics:
+    """Per-stage timings and counters for one import run.
+
+    Stages, each observed once per unit of work:
+      read          CSV bytes to csv.reader rows (IndexedCSV, or OffsetCSVReader for .gz), per parse block
+      parse         row normalization (parse_rows), per parse block
+      group         visit grouping, per row
+      serialize     JSON encoding, per patient/visit and per batch body
+      compress      gzip compression of the batch body, per batch
+      backpressure  reader blocked waiting for an in-flight slot, per batch
+      send          request round trip, per request
+      decode        response decoding and bookkeeping, per response
+    Counters cover rows and bytes read, requests, bytes on the wire, failures and retries.
+
+    Programmatic callers pass an instance to import_patients_and_visits() and read
+    snapshot() afterwards (or while it runs, from another thread). A disabled instance
+    hands out no-op stages and ignores counters, so instrumentation then costs little
+    more than the clock reads at each call site.
+    """
+
+    STAGES = ("read", "parse", "group", "serialize", "compress", "backpressure", "send", "decode")
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.monotonic()
+        self.stages = {name: StageMetrics(name) for name in self.STAGES} if enabled else {}
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+        self.report_file = None
+        self.report_thread = None
+        self.report_stop = threading.Event()
+
+    def stage(self, name):
+        """Returns the StageMetrics for name (a no-op stage when disabled)."""
+        if not self.enabled:
+            return NULL_STAGE_METRICS
+        return self.stages[name]
+
+    def increment(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += amount
+
+    def state(self):
+        """Picklable raw state, for handing metrics collected in a parse worker to merge()."""
+        with self.lock:
+            counters = dict(self.counters)
+        return {"stages": {name: (stage.count, stage.items, stage.total_seconds, stage.max_seconds, list(stage.buckets))
+                           for name, stage in self.stages.items() if stage.count},
+                "counters": counters}
+
+    def merge(self, state):
+        """Adds the observations and counters of another instance's state() to this one."""
+        if not self.enabled or not state:
+            return
+        for name, (count, items, total_seconds, max_seconds, buckets) in state["stages"].items():
+            stage = self.stages[name]
+            with stage.lock:
+                stage.count += count
+                stage.items += items
+                stage.total_seconds += total_seconds
+                stage.max_seconds = max(stage.max_seconds, max_seconds)
+                stage.buckets = [mine + theirs for mine, theirs in zip(stage.buckets, buckets)]
+        for name, value in state["counters"].items():
+            self.increment(name, value)
+
+    def snapshot(self):
+        """Returns the current stage metrics and counters as a JSON-serializable dict."""
+        with self.lock:
+            counters = dict(sorted(self.counters.items()))
+        return {
+            "elapsed_seconds": round(time.monotonic() - self.started, 3),
+            "stages": {name: stage.snapshot() for name, stage in self.stages.items()},
+            "counters": counters,
+        }
+
+    def start_reporting(self, path, interval=METRICS_REPORT_INTERVAL_SECONDS):
+        """Appends a {"type": "progress", ...} JSON line to path every interval seconds."""
+        if not self.enabled:
+            return
+        self.report_file = open(path, mode='a', encoding='utf-8')
+        self.report_stop.clear()
+        self.report_thread = threading.Thread(target=self._report_loop, args=(interval,), name="metrics-reporter", daemon=True)
+        self.report_thread.start()
+
+    def _report_loop(self, interval):
+        while not self.report_stop.wait(interval):
+            self._write_report("progress")
+
+    def _write_report(self, report_type):
+        line = json.dumps({"type": report_type, "time": datetime.now().isoformat(timespec='seconds'), **self.snapshot()})
+        with self.lock:
+            self.report_file.write(line + "\n")
+            self.report_file.flush()
+
+    def stop_reporting(self):
+        """Stops the periodic reporter and writes a final {"type": "final", ...} line."""
+        if self.report_thread is None:
+            return
+        self.report_stop.set()
+        self.report_thread.join()
+        self.report_thread = None
+        self._write_report("final")
+        self.report_file.close()
+        self.report_file = None
+
+    def print_report(self):
+        snapshot = self.snapshot()
+        print(f"\n--- Import Metrics ({snapshot['elapsed_seconds']:.1f} s) ---")
+        print(f"{'stage':<14}{'count':>9}{'items':>10}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, stage in snapshot["stages"].items():
+            print(f"{name:<14}{stage['count']:>9}{stage['items']:>10}{stage['total_seconds']:>10.2f}{stage['mean_ms']:>10.2f}"
+                  f"{stage['p50_ms']:>10.2f}{stage['p99_ms']:>10.2f}{stage['max_ms']:>10.2f}")
+        for name, value in snapshot["counters"].items():
+            print(f"  {name}: {value}")
+
+DISABLED_METRICS = ImportMetrics(enabled=False)
+
+def is_gzip_path(path):
+    return path.lower().endswith('.gz')
+
+def open_csv_reader(path):
+    """Opens a CSV export for reading (offset, row) pairs. Plain files are memory-mapped
+    through IndexedCSV; .gz files are decompressed on the fly by an OffsetCSVReader
+    (offsets then refer to the decompressed bytes, and there is no row index)."""
+    if is_gzip_path(path):
+        return OffsetCSVReader(gzip.open(path, mode='rb'))
+    return IndexedCSV(path)
+
+class OffsetCSVReader:
+    """csv.reader over a file opened in binary mode that tracks record byte offsets.
+
+    Text-mode files disable tell() while being iterated, so lines are read and decoded
+    here and fed to csv.reader one at a time. Iterating yields (offset, row) where offset
+    is where the record starts and row is the list of fields in fieldnames order; seek()
+    jumps to an offset previously yielded. Closing the reader closes the file.
+    """
+
+    def __init__(self, binary_file):
+        self.file = binary_file
+        self.offset = 0
+        self.bytes_read = 0
+        self.reader = csv.reader(self._lines())
+        self.fieldnames = next(self.reader, None) or None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def _lines(self):
+        first_line = self.offset == 0
+        while True:
+            line = self.file.readline()
+            if not line:
+                return
+            self.offset += len(line)
+            self.bytes_read += len(line)
+            text = line.decode('utf-8')
+            if first_line:
+                text = text.lstrip('\ufeff') # Same as encoding='utf-8-sig'
+                first_line = False
+            yield text
+
+    def seek(self, offset):
+        if offset > self.offset:
+            self.file.seek(offset)
+            self.offset = offset
+
+    def __iter__(self):
+        row_offset = self.offset
+        for row in self.reader:
+            yield row_offset, row
+            row_offset = self.offset
+
+# Parallel parsing: rows are normalized by parse_rows() in this many worker processes, each
+# handling a byte range of about PARSE_CHUNK_BYTES that starts and ends on a record boundary.
+# 1 parses inline on the main process.
+PARSE_WORKERS = 1
+PARSE_CHUNK_BYTES = 8 * 1024 * 1024
+
+def find_chunk_boundaries(path, start_offset, chunk_bytes=PARSE_CHUNK_BYTES):
+    """Splits [start_offset, end of file) into byte ranges that start and end on CSV records.
+
+    A newline ends a record only when it is outside quotes, i.e. when an even number of
+    '"' characters precede it (escaped quotes come in pairs and keep the parity). The
+    scan only counts quotes, which is much cheaper than parsing.
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [start_offset]
+    with open(path, mode='rb') as csvfile:
+        csvfile.seek(start_offset)
+        position = start_offset
+        inside_quotes = False
+        while position < file_size:
+            target = min(boundaries[-1] + chunk_bytes, file_size)
+            while position < target:
+                block = csvfile.read(min(1024 * 1024, target - position))
+                inside_quotes ^= block.count(b'"') % 2 == 1
+                position += len(block)
+            # Move forward to the end of the first line that leaves us outside quotes.
+            while position < file_size:
+                line = csvfile.readline()
+                inside_quotes ^= line.count(b'"') % 2 == 1
+                position += len(line)
+                if not inside_quotes:
+                    break
+            boundaries.append(position)
+    return list(zip(boundaries, boundaries[1:]))
+
+def parse_csv_chunk(path, fieldnames, start_offset, end_offset, collect_metrics=False):
+    """Worker entry point: parses and normalizes the rows of one byte range.
+
+    Returns (parsed rows, ImportMetrics.state() of the read/parse stages or None).
+    """
+    metrics = ImportMetrics(enabled=collect_metrics)
+    with IndexedCSV(path, load_index=False) as reader:
+        reader.fieldnames = fieldnames
+        parsed_rows = list(iter_parsed_rows(reader, metrics=metrics, rows=reader.iter_rows(start_offset, end_offset)))
+    return parsed_rows, metrics.state() if collect_metrics else None
+
+def iter_parsed_rows_parallel(path, fieldnames, start_offset, workers=PARSE_WORKERS, chunk_bytes=PARSE_CHUNK_BYTES,
+                              metrics=None, indexed_reader=None):
+    """Yields ParsedRows (None for rows without a PReg) in file order from a process pool.
+
+    A few chunks are kept in progress ahead of the consumer and results are yielded
+    strictly in chunk order, so first-row-wins per (PReg, Date) and first demographics
+    per PReg behave exactly as with inline parsing. With an indexed IndexedCSV as
+    indexed_reader the chunk boundaries come from its row offsets instead of a scan.
+    """
+    metrics = metrics or DISABLED_METRICS
+    if indexed_reader is not None and indexed_reader.has_index:
+        chunks = indexed_reader.byte_ranges(start_offset, chunk_bytes)
+    else:
+        chunks = find_chunk_boundaries(path, start_offset, chunk_bytes)
+    print(f"Parsing {len(chunks)} chunks of ~{chunk_bytes // (1024 * 1024)} MB with {workers} worker processes.")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunk_iter = iter(chunks)
+        pending = deque(executor.submit(parse_csv_chunk, path, fieldnames, start, end, metrics.enabled)
+                        for start, end in itertools.islice(chunk_iter, workers * 2))
+        while pending:
+            parsed_rows, worker_metrics = pending.popleft().result()
+            metrics.merge(worker_metrics) # Read/parse times are worker CPU time, summed over workers
+            for start, end in itertools.islice(chunk_iter, 1):
+                pending.append(executor.submit(parse_csv_chunk, path, fieldnames, start, end, metrics.enabled))
+            yield from parsed_rows
+
+class ResumeState:
+    """What a previous run recorded in its checkpoint journal."""
+
+    def __init__(self):
+        self.offset = 0
+        self.row_index = 0
+        self.max_preg = 0
+        self.complete = False
+        self.import_demographics = None
+        self.import_visits = None
+        self.completed_pregs = set()
+        self.completed_visit_keys = set()
+        self.failed_patients = {} # pReg -> payload
+        self.failed_visits = {} # (pReg, original date) -> payload
+
+class CheckpointJournal:
+    """Append-only JSON-lines journal of acknowledged batches and safe resume offsets.
+
+    Entry types:
+      start      - a run began (csv path, size, which endpoints are imported)
+      batch      - a batch came back: keys that succeeded, server counts, and the full
+                   payloads of items that failed so a resume can retry just those
+      watermark  - every row before "offset" has been sent and acknowledged
+      complete   - the whole CSV has been read and every batch acknowledged
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        self.last_watermark = None
+
+    def open(self, csv_path, resume, import_demographics, import_visits):
+        self.file = open(self.path, mode='a' if resume else 'w', encoding='utf-8')
+        self._write({"type": "start", "csv": os.path.abspath(csv_path), "size": os.path.getsize(csv_path),
+                     "resume": resume, "importDemographics": import_demographics, "importVisits": import_visits,
+                     "time": datetime.now().isoformat(timespec='seconds')})
+
+    def record_batch(self, payload_key, status, response_data, succeeded_keys, failed_items, min_offset, max_offset):
+        if payload_key == "visits":
+            failed_items = [visit.to_payload() for visit in failed_items]
+        self._write({"type": "batch", "endpoint": payload_key, "status": status,
+                     "successCount": response_data.get("successCount", 0) if response_data else 0,
+                     "failureCount": response_data.get("failureCount", 0) if response_data else len(failed_items),
+                     "minOffset": min_offset, "maxOffset": max_offset,
+                     "keys": succeeded_keys, "failed": failed_items})
+
+    def record_watermark(self, offset, row_index, max_preg):
+        if offset == self.last_watermark:
+            return
+        self.last_watermark = offset
+        self._write({"type": "watermark", "offset": offset, "rowIndex": row_index, "maxPReg": max_preg})
+
+    def record_complete(self, max_preg):
+        self._write({"type": "complete", "maxPReg": max_preg})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    @staticmethod
+    def load(path):
+        """Replays a journal into a ResumeState."""
+        state = ResumeState()
+        visit_batches = [] # (maxOffset, keys), filtered once the final watermark is known
+        with open(path, mode='r', encoding='utf-8') as journal_file:
+            for line in journal_file:
                 try:
-                    response_data = json.loads(body)
-                    total_visits_successfully_imported += response_data.get("successCount", 0)
-                    if response_data.get("failureCount", 0) > 0:
-                        print(f"  Visit batch had {response_data.get('failureCount',0)} failures. Details: {response_data.get('errors', [])}")
-                        detailed_visit_failures.extend(response_data.get('errors', []))
+                    entry = json.loads(line)
                 except json.JSONDecodeError:
-                    print(f"  ERROR decoding visit batch response: {body}")
-                    overall_failed_visit_batches +=1
-            elif status is not None:
-                print(f"  ERROR in visit batch. Status: {status}, Response: {body}")
-                overall_failed_visit_batches +=1
-            visit_batch = [] # Reset batch
-            if conn is None and status is not None and status != "CONN_REFUSED": time.sleep(1)
-
-    # Send any remaining visits
-    if visit_batch:
-        print(f"Sending final batch of {len(visit_batch)} visits...")
-        status, body, conn = send_batch_request(conn, TARGET_HOST, ADD_HISTORICAL_VISIT_FUNCTION_PATH, "visits", visit_batch, headers)
-        if status == "CONN_REFUSED": return
-        if status and (status == 201 or status == 207):
-            try:
-                response_data = json.loads(body)
-                total_visits_successfully_imported += response_data.get("successCount", 0)
-                if response_data.get("failureCount", 0) > 0:
-                    print(f"  Final visit batch had {response_data.get('failureCount',0)} failures. Details: {response_data.get('errors', [])}")
-                    detailed_visit_failures.extend(response_data.get('errors', []))
-            except json.JSONDecodeError:
-                print(f"  ERROR decoding final visit batch response: {body}")
-                overall_failed_visit_batches +=1
-        elif status is not None:
-            print(f"  ERROR in final visit batch. Status: {status}, Response: {body}")
-            overall_failed_visit_batches +=1
-    
-    if conn: conn.close()
-
-    print(f"\n--- Historical Visit Import Summary ---")
-    print(f"Total unique visits prepared for batching: {len(visits_to_process_map)} (sent as {total_visits_processed_in_batches} items in batches)")
-    print(f"Successfully imported visits reported by server: {total_visits_successfully_imported}")
-    print(f"Total visit batches resulting in errors: {overall_failed_visit_batches}")
-    print(f"Total individual visits reported as failed by server: {len(detailed_visit_failures)}")
-    if detailed_visit_failures:
-        print("Details of visits that failed server-side processing (first 10 shown):")
-        for failure in detailed_visit_failures[:10]:
-            print(f"  - PReg: {failure.get('patientId', 'N/A')}, VisitDate: {failure.get('visitDate', failure.get('item',{}).get('visitData',{}).get('visitDate','N/A'))}, Reason: {failure.get('error', failure.get('reason', 'Unknown'))}")
+                    continue # Torn last line from a crash
+                entry_type = entry.get("type")
+                if entry_type == "start" and not entry.get("resume"):
+                    state.import_demographics = entry.get("importDemographics")
+                    state.import_visits = entry.get("importVisits")
+                elif entry_type == "batch" and entry.get("endpoint") == "patients":
+                    for preg in entry.get("keys", []):
+                        state.completed_pregs.add(preg)
+                        state.failed_patients.pop(preg, None)
+                    for item in entry.get("failed", []):
+                        state.failed_patients[item["pReg"]] = item
+                elif entry_type == "batch":
+                    keys = [tuple(key) for key in entry.get("keys", [])]
+                    visit_batches.append((entry.get("maxOffset"), keys))
+                    for key in keys:
+                        state.failed_visits.pop(key, None)
+                    for item in entry.get("failed", []):
+                        state.failed_visits[(item["patientId"], item["visitData"]["originalCsvDate"])] = item
+                elif entry_type == "watermark":
+                    state.offset = max(state.offset, entry["offset"])
+                    state.row_index = max(state.row_index, entry.get("rowIndex", 0))
+                    state.max_preg = max(state.max_preg, entry.get("maxPReg", 0))
+                elif entry_type == "complete":
+                    state.complete = True
+                    state.max_preg = max(state.max_preg, entry.get("maxPReg", 0))
+        # Only visits at or past the resume offset can be read again; keep just those keys.
+        for max_offset, keys in visit_batches:
+            if max_offset is None or max_offset >= state.offset:
+                state.completed_visit_keys.update(keys)
+        return state
 
-if __name__ == "__main__":
-    # To run a full import (demographics first, then visits):
-    # 1. Ensure USE_EMULATOR is set correctly at the top of the script.
-    # 2. Uncomment the function calls below.
+class RetryPolicy:
+    """Decides whether and when a failed batch is re-sent, and when it is split instead."""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, split_after_attempts=RETRY_SPLIT_AFTER_ATTEMPTS,
+                 base_delay=RETRY_BASE_DELAY_SECONDS, max_delay=RETRY_MAX_DELAY_SECONDS, item_max_attempts=ITEM_MAX_ATTEMPTS):
+        self.max_attempts = max(1, max_attempts)
+        self.split_after_attempts = max(1, split_after_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.item_max_attempts = max(1, item_max_attempts)
+        self.rng = random.Random()
+
+    def attempt_limit(self, status, item_count):
+        """How many times in total a batch failing with status is sent before giving up or splitting."""
+        if status in TRANSIENT_STATUSES:
+            return self.max_attempts
+        if isinstance(status, int) and status >= 500:
+            return self.max_attempts if item_count == 1 else self.split_after_attempts
+        return 1 # Success, 207, or a 4xx that will fail the same way again
+
+    def retry_delay(self, status, attempt, item_count):
+        """Seconds to wait before re-sending a batch whose attempt-th send got status, or None."""
+        if attempt >= self.attempt_limit(status, item_count):
+            return None
+        return self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def should_split(self, status, item_count):
+        """Whether a batch that finally failed with status is split in half and sent again.
+
+        Only a 400 / 413 (a bad or too large record) or a non-transient 5xx (a record the
+        server chokes on) can be isolated by splitting; any other 4xx (auth, not found,
+        ...) fails the same way for every half, so the batch is given up at once.
+        """
+        if item_count <= 1 or status in TRANSIENT_STATUSES or not isinstance(status, int):
+            return False
+        return status in SPLIT_STATUSES or status >= 500
+
+# A 207-failed item waiting to be put into a later batch
+RetryItem = namedtuple("RetryItem", ["payload_key", "item", "serialized_item", "source_offset", "attempts"])
+
+class BatchDispatcher:
+    """Sends batches from a thread pool with a bounded number of requests in flight.
+
+    submit() blocks once max_in_flight batches are outstanding, which applies
+    backpressure to the CSV reader. Each worker thread reuses its own keep-alive
+    connection. A batch may depend on earlier futures (e.g. visits on the patient
+    batches that create their PRegs) and is only sent once those have completed.
+
+    Failed sends are retried on the same worker as the RetryPolicy allows; the worker
+    keeps its in-flight slot while it backs off, so a struggling server also slows the
+    reader down.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT_REQUESTS, metrics=None, retry_policy=None, gzip_bodies=GZIP_REQUEST_BODIES):
+        self.max_in_flight = max(1, max_in_flight)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.gzip_bodies = gzip_bodies
+        self.metrics = metrics or DISABLED_METRICS
+        self.compress_stage = self.metrics.stage("compress")
+        self.backpressure_stage = self.metrics.stage("backpressure")
+        self.send_stage = self.metrics.stage("send")
+        # One worker per in-flight slot: every submitted batch starts immediately, so a
+        # batch waiting on an earlier dependency can never starve that dependency.
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="batch-sender")
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.response_lock = threading.Lock()
+        self.connection_refused = threading.Event()
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
 
-    # Step 1: Import patient demographic data. This also sets the PReg counter.
-    import_patients()
+    def submit(self, path, json_payload, on_response, depends_on=(), item_count=1):
+        """Queues a batch body (JSON bytes) of item_count items; on_response(status, body,
+        elapsed_seconds, attempts) is called under a lock once it returns for good."""
+        acquire_started = time.perf_counter()
+        self.in_flight.acquire()
+        self.backpressure_stage.observe(time.perf_counter() - acquire_started)
+        try:
+            future = self.executor.submit(self._send, path, json_payload, on_response, list(depends_on), item_count)
+        except Exception:
+            self.in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self.in_flight.release())
+        return future
+
+    def _send(self, path, json_payload, on_response, depends_on, item_count):
+        if depends_on:
+            wait(depends_on)
+
+        # Compressed here, on the sender threads: zlib releases the GIL while it works.
+        headers = {'Content-type': 'application/json'}
+        request_body = json_payload
+        if self.gzip_bodies and len(json_payload) >= GZIP_MIN_BYTES:
+            compress_started = time.perf_counter()
+            request_body = gzip.compress(json_payload, compresslevel=GZIP_LEVEL, mtime=0)
+            self.compress_stage.observe(time.perf_counter() - compress_started)
+            headers['Content-Encoding'] = 'gzip'
+
+        attempt = 0
+        while True:
+            if self.connection_refused.is_set():
+                return
+            attempt += 1
+            conn = getattr(self.local, "conn", None)
+            started = time.monotonic()
+            status, body, new_conn = send_batch_body(conn, TARGET_HOST, path, request_body, headers)
+            elapsed_seconds = time.monotonic() - started
+            self.send_stage.observe(elapsed_seconds)
+            self.metrics.increment("requests")
+            self.metrics.increment("request_bytes", len(request_body))
+            self.metrics.increment("request_bytes_uncompressed", len(json_payload))
+            if body is not None:
+                self.metrics.increment("response_bytes", len(body))
+            if status is None:
+                self.metrics.increment("connection_errors")
+            if new_conn is not None and new_conn is not conn:
+                with self.connections_lock:
+                    self.connections.append(new_conn)
+            self.local.conn = new_conn # None after a reset; the next attempt reconnects
+            if status == "CONN_REFUSED":
+                self.connection_refused.set()
+                return
+
+            delay = self.retry_policy.retry_delay(status, attempt, item_count)
+            if delay is None:
+                break
+            self.metrics.increment("batch_retries")
+            print(f"  Batch of {item_count} to {path} failed (status {status}); retrying in {delay:.1f} s "
+                  f"(attempt {attempt + 1} of {self.retry_policy.attempt_limit(status, item_count)}).")
+            time.sleep(delay)
+
+        with self.response_lock:
+            on_response(status, body, elapsed_seconds, attempt)
+
+    def shutdown(self):
+        """Waits for every in-flight batch and closes the keep-alive connections."""
+        self.executor.shutdown(wait=True)
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+class DryRunDispatcher:
+    """Stands in for BatchDispatcher in --dry-run imports: nothing is sent.
+
+    Batch bodies are measured (and gzip-compressed, to report wire sizes) on the calling
+    thread and acknowledged at once with a 201 saying every item succeeded, so the
+    reading, grouping, batching and serialization run exactly as in a real import.
+    """
+
+    def __init__(self, metrics=None, gzip_bodies=GZIP_REQUEST_BODIES):
+        self.gzip_bodies = gzip_bodies
+        self.metrics = metrics or DISABLED_METRICS
+        self.compress_stage = self.metrics.stage("compress")
+        self.response_lock = threading.Lock()
+        self.connection_refused = threading.Event() # Never set
+        self.batches = defaultdict(list) # path -> [(items, body bytes, wire bytes), ...]
+
+    def submit(self, path, json_payload, on_response, depends_on=(), item_count=1):
+        wire_bytes = len(json_payload)
+        if self.gzip_bodies and len(json_payload) >= GZIP_MIN_BYTES:
+            compress_started = time.perf_counter()
+            wire_bytes = len(gzip.compress(json_payload, compresslevel=GZIP_LEVEL, mtime=0))
+            self.compress_stage.observe(time.perf_counter() - compress_started)
+        self.metrics.increment("requests")
+        self.metrics.increment("request_bytes", wire_bytes)
+        self.metrics.increment("request_bytes_uncompressed", len(json_payload))
+        body = json.dumps({"successCount": item_count, "failureCount": 0, "errors": []})
+        with self.response_lock:
+            self.batches[path].append((item_count, len(json_payload), wire_bytes))
+            on_response(201, body, 0.0, 1)
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def shutdown(self):
+        pass
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list (0 for an empty one)."""
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+# Example rows printed per kind of problem in the --dry-run validation report.
+DRY_RUN_EXAMPLES = 5
+CANONICAL_PREG_PATTERN = re.compile(r"PR-\d+")
+
+class DryRunReport:
+    """Data problems and batch profile gathered by a --dry-run import.
+
+    Rows are checked as the importer processes them (shared by every file of the run):
+    unparseable dates and amounts, missing Names, PRegs that are not "PR-<number>", and
+    (PReg, Date) keys whose rows disagree on the visit details (only the first row's
+    details are imported). Rows skipped because their visit was already sent are counted
+    by the VisitGrouper and shown in the import summary.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.rows_without_preg = 0
+        self.rows_without_date = 0
+        self.rows_without_name = 0
+        self.unparseable_dates = 0
+        self.unparseable_amounts = 0
+        self.pregs = set()
+        self.named_pregs = set()
+        self.noncanonical_pregs = set()
+        self.visit_details = {} # (PReg, Date) -> hash of the first row's visit details
+        self.conflicting_visit_keys = set()
+        self.visits_per_preg = Counter()
+        self.examples = defaultdict(list)
+
+    def example(self, problem, text):
+        if len(self.examples[problem]) < DRY_RUN_EXAMPLES:
+            self.examples[problem].append(text)
+
+    def observe_row(self, row_index, parsed):
+        row_number = row_index + 2 # 1-based, after the header
+        with self.lock:
+            self.rows += 1
+            if parsed is None:
+                self.rows_without_preg += 1
+                return
+            preg = parsed.preg
+            self.pregs.add(preg)
+            if parsed.name:
+                self.named_pregs.add(preg)
+            else:
+                self.rows_without_name += 1
+                self.example("name", f"row {row_number}: PReg {preg}")
+            if not CANONICAL_PREG_PATTERN.fullmatch(preg) and preg not in self.noncanonical_pregs:
+                self.noncanonical_pregs.add(preg)
+                self.example("preg", f"row {row_number}: '{preg}'")
+            if not parsed.amount_valid:
+                self.unparseable_amounts += 1
+                self.example("amount", f"row {row_number}: PReg {preg}, tAmount '{parsed.amount_text}'")
+            if not parsed.date:
+                self.rows_without_date += 1
+                return
+            if parsed.visit_date is None:
+                self.unparseable_dates += 1
+                self.example("date", f"row {row_number}: PReg {preg}, Date '{parsed.date}'")
+                return
+            visit_key = (preg, parsed.date)
+            details = hash((parsed.complaints, parsed.examination, parsed.diagnosis, parsed.investigation,
+                            parsed.advise, parsed.next_plan, parsed.amount_text))
+            first_details = self.visit_details.setdefault(visit_key, details)
+            if first_details != details and visit_key not in self.conflicting_visit_keys:
+                self.conflicting_visit_keys.add(visit_key)
+                self.example("conflict", f"row {row_number}: PReg {preg}, Date {parsed.date}")
+
+    def observe_visit(self, visit):
+        with self.lock:
+            self.visits_per_preg[visit.preg] += 1
+
+    def print_report(self, elapsed_seconds, dispatcher, max_in_flight):
+        print("\n--- Dry Run Validation ---")
+        print(f"Rows read: {self.rows} ({self.rows_without_preg} without a PReg, {self.rows_without_date} without a Date)")
+        problems = [
+            ("date", self.unparseable_dates, "rows with an unparseable Date (their visits are skipped)"),
+            ("name", self.rows_without_name, f"rows without a Name ({len(self.pregs - self.named_pregs)} PRegs never have "
+                                             f"one, so their demographics are skipped)"),
+            ("conflict", len(self.conflicting_visit_keys), "(PReg, Date) visits whose rows disagree on complaints, "
+                                                           "diagnosis, amount etc. (the first row wins)"),
+            ("preg", len(self.noncanonical_pregs), "PRegs not in PR-<number> form"),
+            ("amount", self.unparseable_amounts, "rows with an unparseable tAmount (imported as 0)"),
+        ]
+        for problem, count, description in problems:
+            print(f"{count:>9} {description}")
+            for text in self.examples.get(problem, []):
+                print(f"            e.g. {text}")
+
+        print("\n--- Dry Run Profile ---")
+        rows_per_second = self.rows / elapsed_seconds if elapsed_seconds > 0 else 0
+        print(f"Processed {self.rows} rows in {elapsed_seconds:.2f} s ({rows_per_second:,.0f} rows/s) without sending anything.")
+        visit_counts = sorted(self.visits_per_preg.values())
+        if visit_counts:
+            print(f"Visits per PReg: {len(visit_counts)} PRegs, mean {sum(visit_counts) / len(visit_counts):.1f}, "
+                  f"p50 {percentile(visit_counts, 0.5)}, p90 {percentile(visit_counts, 0.9)}, "
+                  f"p99 {percentile(visit_counts, 0.99)}, max {visit_counts[-1]}")
+        total_requests = 0
+        print(f"{'endpoint':<28}{'requests':>10}{'items':>10}{'items p50':>11}{'bytes p50':>11}{'bytes p99':>11}"
+              f"{'bytes max':>11}{'wire MB':>9}")
+        for path, batches in sorted(dispatcher.batches.items()):
+            items = sorted(batch[0] for batch in batches)
+            body_bytes = sorted(batch[1] for batch in batches)
+            wire_bytes = sum(batch[2] for batch in batches)
+            total_requests += len(batches)
+            print(f"{path:<28}{len(batches):>10}{sum(items):>10}{percentile(items, 0.5):>11}{percentile(body_bytes, 0.5):>11}"
+                  f"{percentile(body_bytes, 0.99):>11}{body_bytes[-1]:>11}{wire_bytes / (1024 * 1024):>9.2f}")
+        # The adaptive sizer only ever saw instant responses, so these are the fewest requests
+        # the import can take; a slow or failing server shrinks batches and adds requests.
+        print(f"Projected requests: {total_requests}, i.e. {math.ceil(total_requests / max(1, max_in_flight))} rounds at "
+              f"{max_in_flight} in flight (batches at their largest; slower responses and retries add more).")
+
+class ContentHashIndex:
+    """Local SQLite index of what the server has already accepted, used by delta imports.
+
+    Maps each PReg and each (PReg, original CSV date) visit key to a hash of the
+    payload that was acknowledged. A record whose payload hashes the same is unchanged
+    and does not need to be sent again. The hash is taken over json.dumps() of the payload
+    with default settings, independent of the wire format, so indexes stay valid when
+    the wire format changes. The hash classify() computes for an item that is to be sent
+    is kept until record_success() stores it.
+    """
+
+    NEW = "new"
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+
+    def __init__(self, path):
+        self.path = path
+        # Lookups happen on the reader thread, updates on sender threads; the lock serializes both.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending_hashes = {} # item key -> hash of items classified NEW / CHANGED, until acknowledged
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS patients (preg TEXT PRIMARY KEY, hash BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS visits (preg TEXT NOT NULL, csv_date TEXT NOT NULL, hash BLOB NOT NULL, "
+                          "PRIMARY KEY (preg, csv_date)) WITHOUT ROWID")
+        self.conn.commit()
+
+    @staticmethod
+    def content_hash(payload_key, item, payload=None):
+        if payload is None:
+            payload = item_payload(payload_key, item)
+        if payload_key == "patients" and "updateExisting" in payload:
+            payload = {key: value for key, value in payload.items() if key != "updateExisting"}
+        canonical = json.dumps(payload)
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+
+    def classify(self, payload_key, item, payload=None):
+        """Returns NEW, CHANGED or UNCHANGED for an item about to be queued (payload: its
+        request payload, if already built)."""
+        key = item["pReg"] if payload_key == "patients" else item.key
+        digest = self.content_hash(payload_key, item, payload)
+        with self.lock:
+            if payload_key == "patients":
+                row = self.conn.execute("SELECT hash FROM patients WHERE preg = ?", (key,)).fetchone()
+            else:
+                row = self.conn.execute("SELECT hash FROM visits WHERE preg = ? AND csv_date = ?", key).fetchone()
+            if row is not None and row[0] == digest:
+                return self.UNCHANGED
+            self.pending_hashes[(payload_key, key)] = digest
+        return self.NEW if row is None else self.CHANGED
+
+    def item_hash(self, payload_key, key, item):
+        """The hash classify() kept for an item (computed again for items it never saw, e.g. journal retries)."""
+        digest = self.pending_hashes.pop((payload_key, key), None)
+        return digest if digest is not None else self.content_hash(payload_key, item)
+
+    def record_success(self, payload_key, items, succeeded_keys):
+        """Stores the hashes of the batch items the server acknowledged."""
+        if not succeeded_keys:
+            return
+        with self.lock:
+            if payload_key == "patients":
+                succeeded = set(succeeded_keys)
+                rows = [(item["pReg"], self.item_hash(payload_key, item["pReg"], item)) for item in items if item["pReg"] in succeeded]
+                sql = "INSERT OR REPLACE INTO patients (preg, hash) VALUES (?, ?)"
+            else:
+                succeeded = {tuple(key) for key in succeeded_keys}
+                rows = [(item.preg, item.csv_date, self.item_hash(payload_key, item.key, item)) for item in items if item.key in succeeded]
+                sql = "INSERT OR REPLACE INTO visits (preg, csv_date, hash) VALUES (?, ?, ?)"
+            self.conn.executemany(sql, rows)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class PatientSearchIndex:
+    """Prebuilt type-ahead index of imported patients, written as one JSON file that the
+    front end loads once (patient_search_index.js) to search locally instead of calling
+    searchPatients on every keystroke.
+
+    The file holds the patients as [pReg, name, contactNo, nicNo] rows plus a sorted
+    array of search keys with a parallel array of row numbers: name_normalized, each later
+    word of it, the lower-cased PReg, and the digits of contactNo and nicNo. A prefix
+    lookup is a binary search followed by a short scan. Imported patients use their PReg
+    as Firestore document ID, so a hit can be loaded with getPatient.
+
+    The file is also the index's state: it is loaded at start, patients the server
+    acknowledges (or that delta mode found unchanged) are added or replaced by PReg, and
+    save() rewrites it; during an import save_if_due() also rewrites it every
+    SEARCH_INDEX_SAVE_INTERVAL_SECONDS, so a crash loses little. It holds names, phone
+    numbers and NIC numbers, so serve it only to signed-in clinic staff.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock() # Updated from sender threads
+        self.save_lock = threading.Lock() # Saved from the reader thread of every file
+        self.patients = {} # pReg -> [pReg, name, contactNo, nicNo]
+        self.updated = 0
+        self.saved_updates = 0
+        self.last_saved = time.monotonic()
+        try:
+            with open(path, mode='r', encoding='utf-8') as index_file:
+                data = json.load(index_file)
+            if data.get("version") == self.VERSION:
+                self.patients = {row[0]: row for row in data["patients"]}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Warning: Rebuilding unreadable patient search index {path}: {e}")
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __contains__(self, preg):
+        return preg in self.patients
+
+    def add(self, patients):
+        """Adds or replaces createPatientHttp payloads."""
+        with self.lock:
+            for patient in patients:
+                self.patients[patient["pReg"]] = [patient["pReg"], patient.get("name", ""),
+                                                  patient.get("contactNo", ""), patient.get("nicNo", "")]
+            self.updated += len(patients)
+
+    def record_success(self, payload_key, items, succeeded_keys):
+        if payload_key == "patients" and succeeded_keys:
+            succeeded = set(succeeded_keys)
+            self.add([item for item in items if item["pReg"] in succeeded])
+
+    @staticmethod
+    def search_keys(row):
+        preg, name, contact_no, nic_no = row
+        name_normalized = name.lower().strip()
+        words = name_normalized.split()
+        keys = {name_normalized, preg.lower()}
+        keys.update(' '.join(words[position:]) for position in range(1, len(words)))
+        for number in (contact_no, nic_no):
+            digits = ''.join(character for character in number if character.isdigit())
+            if digits:
+                keys.add(digits)
+        keys.discard('')
+        return keys
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                rows = sorted(self.patients.values(), key=lambda row: (row[1].lower().strip(), row[0]))
+                updated = self.updated
+            entries = sorted((key, row_number) for row_number, row in enumerate(rows) for key in self.search_keys(row))
+            data = {"version": self.VERSION, "generatedAt": datetime.now().isoformat(timespec='seconds'),
+                    "fields": ["pReg", "name", "contactNo", "nicNo"], "patients": rows,
+                    "keys": [key for key, _ in entries], "refs": [row_number for _, row_number in entries]}
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, mode='w', encoding='utf-8') as index_file:
+                json.dump(data, index_file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+            self.saved_updates = updated
+            self.last_saved = time.monotonic()
+        print(f"Patient search index {self.path}: {len(rows)} patients, {len(entries)} keys ({updated} added or updated this run).")
+
+    def save_if_due(self, interval=SEARCH_INDEX_SAVE_INTERVAL_SECONDS):
+        """Saves if patients were added since the last save and interval seconds have passed."""
+        if self.updated != self.saved_updates and time.monotonic() - self.last_saved >= interval \
+                and not self.save_lock.locked():
+            self.save()
+
+class PatientRegistry:
+    """Which PRegs have had their demographics queued, shared by every file of an import.
+
+    The first file to see a PReg claims it and sends its patient; the entry then records
+    the future of the patient batch it went out in, so visit batches from any file can
+    wait for it. An entry of None means the patient is still in its file's pending batch,
+    and False that its file failed before sending it (see abandon()).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.patient_batches = {} # PReg -> future of its patient batch, None while pending, True if already imported, False if abandoned
+
+    def __contains__(self, preg):
+        return preg in self.patient_batches
+
+    def __len__(self):
+        return len(self.patient_batches)
+
+    def claim(self, preg):
+        """Returns True if the caller is the first to queue demographics for preg."""
+        with self.lock:
+            if preg in self.patient_batches:
+                return False
+            self.patient_batches[preg] = None
+            return True
+
+    def mark_existing(self, pregs):
+        """Records PRegs whose patient needs no request (already imported, or unchanged in delta mode)."""
+        with self.changed:
+            for preg in pregs:
+                self.patient_batches[preg] = True
+            self.changed.notify_all()
+
+    def mark_submitted(self, pregs, future):
+        with self.changed:
+            for preg in pregs:
+                self.patient_batches[preg] = future
+            self.changed.notify_all()
+
+    def abandon(self, pregs):
+        """Records that the claims on pregs will never be sent because their file failed,
+        so visits from other files stop waiting for them."""
+        with self.changed:
+            for preg in pregs:
+                if preg in self.patient_batches and self.patient_batches[preg] is None:
+                    self.patient_batches[preg] = False
+            self.changed.notify_all()
+
+    def mark_pending(self, pregs):
+        """Records PRegs whose patient batch failed and that are queued to be sent again."""
+        with self.changed:
+            for preg in pregs:
+                self.patient_batches[preg] = None
+            self.changed.notify_all()
+
+    def dependencies(self, pregs):
+        """Returns (patient batch futures still in flight, PRegs whose patient is not sent yet,
+        PRegs whose patient was abandoned)."""
+        futures = {}
+        pending = set()
+        abandoned = set()
+        with self.lock:
+            for preg in pregs:
+                entry = self.patient_batches.get(preg, True)
+                if entry is None:
+                    pending.add(preg)
+                elif entry is False:
+                    abandoned.add(preg)
+                elif entry is not True and not entry.done():
+                    futures[id(entry)] = entry
+        return list(futures.values()), pending, abandoned
+
+    def wait_for_change(self, timeout):
+        with self.changed:
+            self.changed.wait(timeout)
+
+class StreamingImporter:
+    """Reads the clinic CSV once and sends patient and visit batches from the same pass.
+
+    Patients are always sent before any visit batch that could reference them: a visit
+    batch first flushes the pending patient batch and is then held back by the
+    dispatcher until every in-flight patient batch sharing one of its PRegs has returned.
+    """
+
+    def __init__(self, import_demographics=True, import_visits=True, max_in_flight=MAX_IN_FLIGHT_REQUESTS,
+                 journal=None, resume_state=None, delta_index=None, delta_include_changed_visits=False,
+                 parse_workers=PARSE_WORKERS, metrics=None, retry_policy=None, wire_format=WIRE_FORMAT,
+                 gzip_bodies=GZIP_REQUEST_BODIES, csv_path=None, dispatcher=None, patient_registry=None,
+                 only_pregs=None, search_index=None, dry_run_report=None):
+        self.csv_path = csv_path or CSV_FILE_PATH
+        self.dry_run_report = dry_run_report # Validates every row; nothing is recorded in the delta index
+        self.only_pregs = only_pregs # Read just these PRegs' rows through the CSV's row index
+        self.search_index = search_index # PatientSearchIndex updated with every acknowledged patient
+        self.import_demographics = import_demographics
+        self.wire_format = wire_format
+        self.gzip_bodies = gzip_bodies
+        self.parse_workers = parse_workers
+        self.import_visits = import_visits
+        self.max_in_flight = max_in_flight
+        self.journal = journal
+        self.resume_state = resume_state
+        self.delta_index = delta_index
+        self.delta_include_changed_visits = delta_include_changed_visits
+        self.metrics = metrics or DISABLED_METRICS
+        self.group_stage = self.metrics.stage("group")
+        self.serialize_stage = self.metrics.stage("serialize")
+        self.decode_stage = self.metrics.stage("decode")
+        self.retry_policy = retry_policy or RetryPolicy()
+        # A dispatcher passed in is shared with other importers and shut down by the caller.
+        self.dispatcher = dispatcher
+        self.owns_dispatcher = dispatcher is None
+        self.patient_registry = patient_registry if patient_registry is not None else PatientRegistry()
+        self.outstanding_futures = set()
+        self.batches_submitted = 0
+        # batch_id -> min source offset of batches sent but not yet acknowledged
+        self.unacknowledged_offsets = {}
+        # Split batches and 207-failed items handed back by sender threads, and the lowest
+        # source offset among those being moved into new batches by requeue_failures()
+        self.retry_batches = deque()
+        self.retry_items = deque()
+        self.requeue_offset = None
+        self.unacknowledged_lock = threading.Lock() # Also guards retry_batches / retry_items
+        self.current_row_offset = 0
+        self.current_row_index = 0
+        # (offset, row index) of the rows read at or after the last watermark, so the row
+        # index recorded with a watermark is the one of the row at that offset
+        self.row_indexes = deque()
+
+        self.completed_visit_keys = set()
+        self.max_preg_val_from_csv = 0 # To store the highest PReg number
+        self.skipped_already_imported = 0
+        self.delta_unchanged = {"patients": 0, "visits": 0}
+        self.delta_changed = {"patients": 0, "visits": 0}
+        self.delta_changed_visits_skipped = 0
+        self.delta_updates_not_applied = 0
+        self.patient_batch = PendingBatch("patients")
+        self.visit_batch = PendingBatch("visits")
+        self.patient_sizer = AdaptiveBatchSizer(max_items=PATIENT_BATCH_MAX_ITEMS)
+        self.visit_sizer = AdaptiveBatchSizer(max_items=VISIT_BATCH_MAX_ITEMS)
+        self.patient_stats = BatchStats()
+        self.visit_stats = BatchStats()
+        self.visit_grouper = VisitGrouper()
+
+        if resume_state:
+            self.patient_registry.mark_existing(resume_state.completed_pregs)
+            self.completed_visit_keys = resume_state.completed_visit_keys
+            self.max_preg_val_from_csv = resume_state.max_preg
+            self.current_row_offset = resume_state.offset
+            self.current_row_index = resume_state.row_index
+
+    def run(self):
+        succeeded = False
+        try:
+            succeeded = self.import_csv()
+        finally:
+            if not succeeded:
+                self.abandon_unsent_patients()
+        return succeeded
+
+    def import_csv(self):
+        print(f"Starting single-pass import from: {self.csv_path}")
+        if self.import_demographics:
+            print(f"Targeting Patient Creation Cloud Function (batch) at: http{'s' if not USE_EMULATOR else ''}://{TARGET_HOST}{CREATE_PATIENT_FUNCTION_PATH}")
+        if self.import_visits:
+            print(f"Targeting Add Historical Visit Cloud Function (batch) at: http{'s' if not USE_EMULATOR else ''}://{TARGET_HOST}{ADD_HISTORICAL_VISIT_FUNCTION_PATH}")
+        print(f"Using starting BATCH_SIZE: {BATCH_SIZE} (adaptive, max {PATIENT_BATCH_MAX_ITEMS} patients / {VISIT_BATCH_MAX_ITEMS} visits / {MAX_BATCH_BYTES} bytes), MAX_IN_FLIGHT_REQUESTS: {self.max_in_flight}")
+        print(f"Wire format: {self.wire_format}{' (orjson)' if orjson is not None else ''}, gzip request bodies: {'on' if self.gzip_bodies else 'off'}")
+        if self.dry_run_report is not None:
+            print("Dry run: batches are built and measured but nothing is sent.")
+
+        if self.owns_dispatcher:
+            self.dispatcher = BatchDispatcher(self.max_in_flight, self.metrics, self.retry_policy, self.gzip_bodies)
+        try:
+            with open_csv_reader(self.csv_path) as reader:
+                if not reader.fieldnames: # Basic CSV check
+                    print("Error: CSV file appears to be empty or header is missing.")
+                    return False
+                indexed_reader = reader if isinstance(reader, IndexedCSV) else None
+                if indexed_reader is not None and indexed_reader.has_index:
+                    self.visit_grouper.preg_end_offset = indexed_reader.preg_end_offset
+
+                first_row_index = 0
+                start_offset = reader.offset
+                if self.resume_state:
+                    self.retry_journal_failures()
+                    if self.connection_refused: return False
+                    if self.search_index is not None:
+                        self.restore_search_index(reader)
+                    if self.resume_state.complete:
+                        print("Journal shows the CSV was fully read in the previous run; only failed items are retried.")
+                        start_offset = None
+                    else:
+                        print(f"Resuming at byte offset {self.resume_state.offset} (row {self.resume_state.row_index + 2}).")
+                        reader.seek(self.resume_state.offset)
+                        start_offset = reader.offset
+                        first_row_index = self.resume_state.row_index
+
+                if self.only_pregs is not None:
+                    if indexed_reader is None:
+                        print("Error: Importing selected PRegs needs a row index, which .gz files do not have.")
+                        return False
+                    indexed_reader.build_index()
+                    found = sum(1 for preg in self.only_pregs if preg in indexed_reader.preg_ranges)
+                    print(f"Importing only {found} of the {len(self.only_pregs)} selected PRegs found in the CSV.")
+                    parsed_rows = iter_parsed_rows(reader, metrics=self.metrics, rows=indexed_reader.iter_preg_rows(self.only_pregs))
+                elif start_offset is None:
+                    parsed_rows = ()
+                elif self.parse_workers > 1 and indexed_reader is not None:
+                    parsed_rows = iter_parsed_rows_parallel(self.csv_path, reader.fieldnames, start_offset, self.parse_workers,
+                                                            metrics=self.metrics, indexed_reader=indexed_reader)
+                else:
+                    parsed_rows = iter_parsed_rows(reader, metrics=self.metrics)
+
+                for row_index, parsed in enumerate(parsed_rows, start=first_row_index):
+                    if ROW_LIMIT_FOR_TESTING and row_index >= ROW_LIMIT_FOR_TESTING:
+                        print(f"Reached testing row limit of {ROW_LIMIT_FOR_TESTING}. Stopping import.")
+                        break
+                    if self.dry_run_report is not None:
+                        self.dry_run_report.observe_row(row_index, parsed)
+                    if parsed is None:
+                        continue # Skip rows with no PReg
+                    self.current_row_offset = parsed.offset
+                    self.current_row_index = row_index
+                    if self.journal:
+                        self.row_indexes.append((parsed.offset, row_index))
+                    self.process_row(row_index, parsed)
+                    if self.retry_batches or self.retry_items:
+                        self.requeue_failures()
+                    if self.connection_refused: return False
+
+            for visit in self.visit_grouper.flush():
+                self.queue_visit(visit)
+                if self.connection_refused: return False
+            # Send any remaining items; patients always go first.
+            self.send_patient_batch(final=True)
+            self.send_visit_batch(final=True)
+            self.finish_retries()
+        except FileNotFoundError:
+            print(f"FATAL Error: CSV file not found at {self.csv_path}.")
+            return False
+        except Exception as e:
+            print(f"An unexpected error occurred during import: {e}")
+            return False
+        finally:
+            if self.owns_dispatcher:
+                self.dispatcher.shutdown()
+        if self.journal and not self.connection_refused:
+            self.journal.record_complete(self.max_preg_val_from_csv)
+        return not self.connection_refused
+
+    def abandon_unsent_patients(self):
+        """Releases the PRegs this file claimed but never sent, for the other files still running."""
+        pregs = [patient["pReg"] for patient in self.patient_batch.items]
+        with self.unacknowledged_lock:
+            pregs.extend(retry.item["pReg"] for retry in self.retry_items if retry.payload_key == "patients")
+            pregs.extend(patient["pReg"] for batch in self.retry_batches if batch.payload_key == "patients" for patient in batch.items)
+        self.patient_registry.abandon(pregs)
+
+    @property
+    def connection_refused(self):
+        return self.dispatcher is not None and self.dispatcher.connection_refused.is_set()
+
+    def retry_journal_failures(self):
+        """Re-queues the items the previous run recorded as failed, patients first."""
+        failed_patients = list(self.resume_state.failed_patients.values()) if self.import_demographics else []
+        failed_visits = list(self.resume_state.failed_visits.values()) if self.import_visits else []
+        if not failed_patients and not failed_visits:
+            return
+        print(f"Retrying {len(failed_patients)} patients and {len(failed_visits)} visits that failed in the previous run...")
+        self.metrics.increment("retried_items", len(failed_patients) + len(failed_visits))
+        for patient in failed_patients:
+            self.patient_registry.claim(patient["pReg"])
+            self.queue_patient(patient)
+            if self.connection_refused: return
+        for payload in failed_visits:
+            visit = VisitRecord.from_payload(payload)
+            self.completed_visit_keys.add(visit.key)
+            self.queue_visit(visit)
+            if self.connection_refused: return
 
-    # Step 2: Import all historical visits for the patients.
-    import_historical_visits()
+    def restore_search_index(self, reader):
+        """Adds the patients the journal has as acknowledged but the search index is missing
+        (saved before the previous run stopped), reading their rows through the CSV's row index."""
+        missing = {preg for preg in self.resume_state.completed_pregs if preg not in self.search_index}
+        if not missing:
+            return
+        if not isinstance(reader, IndexedCSV):
+            print(f"Warning: {len(missing)} imported patients are missing from the patient search index; "
+                  f".gz files have no row index to read them from, so re-run with the uncompressed CSV to add them.")
+            return
+        print(f"Adding {len(missing)} imported patients missing from the patient search index...")
+        reader.build_index()
+        patients = {}
+        for parsed in iter_parsed_rows(reader, rows=reader.iter_preg_rows(missing)):
+            if parsed is not None and parsed.name and parsed.preg not in patients:
+                patients[parsed.preg] = build_patient_payload(parsed)
+        self.search_index.add(list(patients.values()))
+
+    def process_row(self, row_index, parsed):
+        preg = parsed.preg
+
+        # Numerical part of PReg for counter update
+        preg_num = parsed.preg_number
+        if preg_num is not None and preg_num > self.max_preg_val_from_csv:
+            self.max_preg_val_from_csv = preg_num
+
+        # Process demographics only once per PReg
+        if self.import_demographics and preg not in self.patient_registry:
+            if not parsed.name:
+                print(f"Skipping PReg {preg} (row {row_index + 2}) for demographic import due to missing Name.")
+            elif self.patient_registry.claim(preg): # Another file may have claimed it in the meantime
+                self.queue_patient(build_patient_payload(parsed), parsed.offset)
+                if self.connection_refused: return
+
+        if self.import_visits:
+            if not parsed.date:
+                return
+            if parsed.visit_date is not None and not parsed.amount_valid: # Reported for every row, as before
+                print(f"Warning: Could not parse tAmount '{parsed.amount_text}' for PReg {preg}, visit date {parsed.date}. Using 0.")
+            group_started = time.perf_counter()
+            completed_visits = self.visit_grouper.add_row(parsed)
+            self.group_stage.observe(time.perf_counter() - group_started)
+            for visit in completed_visits:
+                self.queue_visit(visit)
+                if self.connection_refused: return
+
+    def queue_patient(self, patient, source_offset=None):
+        if self.delta_index:
+            change = self.delta_change("patients", patient)
+            if change is None:
+                self.patient_registry.mark_existing([patient["pReg"]])
+                if self.search_index is not None:
+                    self.search_index.add([patient]) # Accepted by an earlier run
+                return
+            if change == ContentHashIndex.CHANGED:
+                # createPatientHttp skips existing patients unless asked to update them
+                patient = {**patient, "updateExisting": True}
+        serialize_started = time.perf_counter()
+        serialized_patient = serialize_payload(patient)
+        self.serialize_stage.observe(time.perf_counter() - serialize_started)
+        self.patient_stats.items_sent += 1
+        self.add_patient(patient, serialized_patient, source_offset)
+
+    def add_patient(self, patient, serialized_patient, source_offset=None, attempts=0):
+        if self.patient_batch.would_overflow(serialized_patient, self.patient_sizer.max_bytes):
+            self.send_patient_batch()
+        self.patient_batch.add(patient, serialized_patient, source_offset, attempts)
+        if len(self.patient_batch) >= self.patient_sizer.current_size:
+            self.send_patient_batch()
+
+    def queue_visit(self, visit):
+        if visit.first_offset is not None and visit.key in self.completed_visit_keys:
+            self.skipped_already_imported += 1 # Acknowledged in the previous run past its last watermark
+            return
+        payload = visit.to_payload()
+        if self.delta_index and self.delta_change("visits", visit, payload) is None:
+            return
+        serialize_started = time.perf_counter()
+        serialized_visit = serialize_payload(payload)
+        self.serialize_stage.observe(time.perf_counter() - serialize_started)
+        if self.dry_run_report is not None:
+            self.dry_run_report.observe_visit(visit)
+        self.visit_stats.items_sent += 1
+        self.add_visit(visit, serialized_visit)
+
+    def add_visit(self, visit, serialized_visit, attempts=0):
+        if self.visit_batch.would_overflow(serialized_visit, self.visit_sizer.max_bytes):
+            self.send_visit_batch()
+        self.visit_batch.add(visit, serialized_visit, visit.first_offset, attempts)
+        if len(self.visit_batch) >= self.visit_sizer.current_size:
+            self.send_visit_batch()
+
+    def delta_change(self, payload_key, item, payload=None):
+        """Classifies an item against the delta index; returns NEW or CHANGED if it is to be sent, else None.
+
+        Changed visits are only sent with delta_include_changed_visits: visits imported
+        before addHistoricalVisitBatch used stable document IDs would be duplicated.
+        """
+        change = self.delta_index.classify(payload_key, item, payload)
+        if change == ContentHashIndex.UNCHANGED:
+            self.delta_unchanged[payload_key] += 1
+            return None
+        if change == ContentHashIndex.CHANGED:
+            self.delta_changed[payload_key] += 1
+            if payload_key == "visits" and not self.delta_include_changed_visits:
+                self.delta_changed_visits_skipped += 1
+                return None
+        return change
+
+    def send_patient_batch(self, final=False):
+        if not self.patient_batch or self.connection_refused:
+            return
+        batch = self.patient_batch
+        if final:
+            print(f"Sending final batch of {len(batch)} patients ({batch.byte_count} bytes)...")
+        else:
+            print(f"Sending batch of {len(batch)} patients ({batch.byte_count} bytes, total processed so far: {self.patient_stats.items_sent})...")
+        label = "Final patient batch" if final else "Patient batch"
+        self.patient_batch = PendingBatch("patients") # Reset batch
+        self.submit_patient_batch(batch, label)
+
+    def submit_patient_batch(self, batch, label):
+        future = self._submit(CREATE_PATIENT_FUNCTION_PATH, batch, self.patient_stats, self.patient_sizer, label)
+        self.patient_registry.mark_submitted([patient["pReg"] for patient in batch.items], future)
+
+    def send_visit_batch(self, final=False):
+        if not self.visit_batch or self.connection_refused:
+            return
+        # Every PReg referenced by these visits must exist before the visits are written.
+        self.send_patient_batch()
+        if self.connection_refused:
+            return
+        batch = self.visit_batch
+        if final:
+            print(f"Sending final batch of {len(batch)} visits ({batch.byte_count} bytes)...")
+        else:
+            print(f"Sending batch of {len(batch)} visits ({batch.byte_count} bytes, total visits processed so far: {self.visit_stats.items_sent})...")
+        label = "Final visit batch" if final else "Visit batch"
+        self.visit_batch = PendingBatch("visits") # Reset batch
+        self.submit_visit_batch(batch, label)
+
+    def submit_visit_batch(self, batch, label):
+        """Submits a visit batch after the patient batches it depends on.
+
+        With several files, a visit whose patient is still pending in another file's
+        batch is held back until that batch has been submitted, and given up if that
+        file fails (see abandon_unsent_patients()).
+        """
+        depends_on, pending_pregs, abandoned_pregs = self.patient_registry.dependencies({visit.preg for visit in batch.items})
+        if pending_pregs or abandoned_pregs:
+            # Their patients are still in another file's pending batch. Hold these visits back
+            # as re-queued items (keeping the watermark behind them) and send the rest. Visits
+            # whose patient that file abandoned are given up.
+            ready = PendingBatch(batch.payload_key)
+            given_up = []
+            with self.unacknowledged_lock:
+                for visit, serialized_visit, offset, attempts in zip(batch.items, batch.serialized_items, batch.offsets, batch.attempts):
+                    if visit.preg in abandoned_pregs:
+                        given_up.append(visit)
+                    elif visit.preg in pending_pregs:
+                        self.retry_items.append(RetryItem("visits", visit, serialized_visit, offset, attempts))
+                    else:
+                        ready.add(visit, serialized_visit, offset, attempts)
+                self.visit_stats.items_given_up += len(given_up)
+            if given_up:
+                print(f"  Giving up on {len(given_up)} visits whose patients another CSV file failed to send; "
+                      f"they are kept in the journal for --resume.")
+                if self.journal:
+                    self.journal.record_batch("visits", None, None, [], given_up, None, None)
+            if not ready:
+                return
+            batch = ready
+        self._submit(ADD_HISTORICAL_VISIT_FUNCTION_PATH, batch, self.visit_stats, self.visit_sizer, label, depends_on)
+
+    def _submit(self, path, batch, stats, sizer, label, depends_on=()):
+        if batch.min_offset is not None:
+            with self.unacknowledged_lock:
+                self.unacknowledged_offsets[batch.batch_id] = batch.min_offset
+
+        def on_response(status, body, elapsed_seconds, attempts):
+            decode_started = time.perf_counter()
+            sizer.record(status, elapsed_seconds, len(batch))
+            stats.batch_retries += attempts - 1
+            response_data = record_batch_response(stats, status, body, label)
+            succeeded_keys, failed_positions = split_batch_outcome(batch.payload_key, batch.items, response_data)
+            self.decode_stage.observe(time.perf_counter() - decode_started, len(batch))
+            self.metrics.increment(f"{batch.payload_key}_acknowledged", len(succeeded_keys))
+            self.metrics.increment(f"{batch.payload_key}_failed", len(failed_positions))
+            if response_data is None:
+                self.metrics.increment("batches_failed")
+            if self.delta_index and self.dry_run_report is None:
+                applied_keys = succeeded_keys
+                if batch.payload_key == "patients" and response_data is not None:
+                    # A changed patient the server only reported as existing (not imported by this
+                    # script) was not updated; keep its old hash so the next run tries again.
+                    not_applied = {result.get("pReg") for result in response_data.get("results", []) if result.get("status") == "exists"}
+                    not_applied &= {patient["pReg"] for patient in batch.items if patient.get("updateExisting")}
+                    if not_applied:
+                        self.delta_updates_not_applied += len(not_applied)
+                        applied_keys = [preg for preg in succeeded_keys if preg not in not_applied]
+                self.delta_index.record_success(batch.payload_key, batch.items, applied_keys)
+            if self.search_index is not None:
+                self.search_index.record_success(batch.payload_key, batch.items, succeeded_keys)
+
+            given_up = []
+            with self.unacknowledged_lock:
+                # Hand split halves and re-queued items to the reader thread before this
+                # batch stops holding the watermark back.
+                if response_data is None and self.retry_policy.should_split(status, len(batch)):
+                    halves = batch.split()
+                    self.retry_batches.extend(halves)
+                    # Visit batches submitted from now on wait for the patients' new batch; those
+                    # already waiting on this one go ahead (Firestore accepts a visit before its patient).
+                    if batch.payload_key == "patients":
+                        self.patient_registry.mark_pending(patient["pReg"] for patient in batch.items)
+                    stats.batches_split += 1
+                    self.metrics.increment("batches_split")
+                    print(f"  Splitting {label.lower()} of {len(batch)} into {len(halves[0])} + {len(halves[1])} to isolate failing records.")
+                else:
+                    for position in failed_positions:
+                        attempts_so_far = batch.attempts[position] + 1
+                        if response_data is not None and attempts_so_far < self.retry_policy.item_max_attempts:
+                            self.retry_items.append(RetryItem(batch.payload_key, batch.items[position], batch.serialized_items[position],
+                                                              batch.offsets[position], attempts_so_far))
+                            if batch.payload_key == "patients":
+                                self.patient_registry.mark_pending([batch.items[position]["pReg"]])
+                        else:
+                            given_up.append(batch.items[position])
+                    requeued = len(failed_positions) - len(given_up)
+                    stats.items_requeued += requeued
+                    stats.items_given_up += len(given_up)
+                    stats.detailed_failures.extend(failure_details(batch.payload_key, given_up, response_data))
+                    self.metrics.increment("items_requeued", requeued)
+                    if given_up:
+                        print(f"  Giving up on {len(given_up)} {batch.payload_key} from {label.lower()}; they are kept in the journal for --resume.")
+                self.unacknowledged_offsets.pop(batch.batch_id, None)
+            if self.journal:
+                self.journal.record_batch(batch.payload_key, status, response_data, succeeded_keys, given_up,
+                                          batch.min_offset, batch.max_offset)
+
+        serialize_started = time.perf_counter()
+        json_payload = None
+        if self.wire_format == "dict":
+            json_payload = encode_dictionary_batch(batch.payload_key, [item_payload(batch.payload_key, item) for item in batch.items])
+        if json_payload is None:
+            json_payload = batch.body()
+        self.serialize_stage.observe(time.perf_counter() - serialize_started, len(batch))
+        self.metrics.increment(f"{batch.payload_key}_sent", len(batch))
+        future = self.dispatcher.submit(path, json_payload, on_response, depends_on=depends_on, item_count=len(batch))
+        self.outstanding_futures = {f for f in self.outstanding_futures if not f.done()}
+        self.outstanding_futures.add(future)
+        self.batches_submitted += 1
+        self.checkpoint()
+        return future
+
+    def requeue_failures(self):
+        """Sends split batches and puts re-queued items into the pending batches (reader thread).
+
+        Batches that still fail with a non-transient error after the dispatcher's retries
+        (see RetryPolicy) come back split in half, and items a 207 reports as failed are
+        re-queued. Patients go first so a visit re-queued together with its patient is
+        sent after it.
+        """
+        with self.unacknowledged_lock:
+            retry_batches, retry_items = list(self.retry_batches), list(self.retry_items)
+            self.retry_batches.clear()
+            self.retry_items.clear()
+            offsets = [batch.min_offset for batch in retry_batches] + [item.source_offset for item in retry_items]
+            self.requeue_offset = min((offset for offset in offsets if offset is not None), default=None)
+        try:
+            for batch in retry_batches:
+                if batch.payload_key == "patients" and not self.connection_refused:
+                    self.submit_patient_batch(batch, "Split patient batch")
+            for retry in retry_items:
+                if retry.payload_key == "patients" and not self.connection_refused:
+                    self.add_patient(retry.item, retry.serialized_item, retry.source_offset, retry.attempts)
+            for batch in retry_batches:
+                if batch.payload_key == "visits" and not self.connection_refused:
+                    self.send_patient_batch()
+                    self.submit_visit_batch(batch, "Split visit batch")
+            for retry in retry_items:
+                if retry.payload_key == "visits" and not self.connection_refused:
+                    self.add_visit(retry.item, retry.serialized_item, retry.attempts)
+        finally:
+            self.requeue_offset = None
+
+    def finish_retries(self):
+        """Waits for the batches still in flight and sends whatever they hand back for retry,
+        until nothing is left."""
+        while not self.connection_refused:
+            pending = [future for future in self.outstanding_futures if not future.done()]
+            if not self.retry_batches and not self.retry_items:
+                if not pending:
+                    return
+                wait(pending, return_when=FIRST_COMPLETED)
+                continue
+            submitted_before = self.batches_submitted
+            self.requeue_failures()
+            self.send_patient_batch(final=True)
+            self.send_visit_batch(final=True)
+            if self.batches_submitted == submitted_before:
+                # Only visits waiting for another file's patients are left
+                if pending:
+                    wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+                else:
+                    self.patient_registry.wait_for_change(timeout=1.0)
+
+    def checkpoint(self):
+        """Records the offset before which every row has been sent and acknowledged.
+
+        A resumed run seeks straight to the last such watermark, skips keys the journal
+        already has, and re-sends only the items that failed (see retry_journal_failures()).
+        """
+        if self.search_index is not None:
+            self.search_index.save_if_due()
+        if not self.journal:
+            return
+        candidates = [self.current_row_offset, self.visit_grouper.min_open_offset(),
+                      self.patient_batch.min_offset, self.visit_batch.min_offset, self.requeue_offset]
+        with self.unacknowledged_lock:
+            candidates.extend(self.unacknowledged_offsets.values())
+            candidates.extend(batch.min_offset for batch in self.retry_batches)
+            candidates.extend(retry.source_offset for retry in self.retry_items)
+        watermark = min(offset for offset in candidates if offset is not None)
+        row_indexes = self.row_indexes
+        while len(row_indexes) > 1 and row_indexes[1][0] <= watermark:
+            row_indexes.popleft()
+        row_index = row_indexes[0][1] if row_indexes and row_indexes[0][0] <= watermark else self.current_row_index
+        self.journal.record_watermark(watermark, row_index, self.max_preg_val_from_csv)
+
+    def print_summary(self):
+        if self.skipped_already_imported:
+            print(f"\nSkipped {self.skipped_already_imported} visits already acknowledged in the previous run.")
+        if self.delta_index:
+            print(f"\n--- Delta Import Summary (index: {self.delta_index.path}) ---")
+            print(f"Unchanged and not sent: {self.delta_unchanged['patients']} patients, {self.delta_unchanged['visits']} visits")
+            print(f"Changed since last import: {self.delta_changed['patients']} patients, {self.delta_changed['visits']} visits")
+            if self.delta_updates_not_applied:
+                print(f"  {self.delta_updates_not_applied} changed patients were NOT updated: their Firestore documents were not "
+                      f"created by an import, so createPatientHttp left them as they are.")
+            if self.delta_changed_visits_skipped:
+                print(f"  {self.delta_changed_visits_skipped} changed visits were NOT re-sent: visits imported before addHistoricalVisitBatch "
+                      f"used stable document IDs would be duplicated. Use --delta-include-changed-visits to send them anyway.")
+        # A dry run's responses are made up, so it only reports what would have been sent
+        dry_run = self.dry_run_report is not None
+        if self.import_demographics and dry_run:
+            print(f"\n--- Patient Demographic Dry Run Summary ---")
+            print(f"Patients that would be sent: {self.patient_stats.items_sent}")
+        elif self.import_demographics:
+            stats = self.patient_stats
+            print(f"\n--- Patient Demographic Import Summary ---")
+            print(f"Total unique PRegs processed for demographics: {stats.items_sent}")
+            print(f"Successfully created or already existing in DB: {stats.success_count}")
+            print(f"Total batches resulting in errors: {stats.failed_batches}")
+            print(f"Individual patient failures reported by server: {stats.failure_reports} (every attempt, including records "
+                  f"that succeeded when re-queued)")
+            print(f"Patient records still failing after their last attempt: {stats.items_given_up}")
+            self.print_retry_summary(stats, "patients")
+            if stats.detailed_failures:
+                print("Details of PRegs that still failed server-side processing (first 10 shown):")
+                for failure in stats.detailed_failures[:10]:
+                    print(f"  - PReg: {failure.get('pReg', failure.get('data', {}).get('pReg', 'N/A'))}, Reason: {failure.get('error', 'Unknown')}")
+
+        if self.import_visits:
+            stats = self.visit_stats
+            print(f"\n--- Historical Visit {'Dry Run' if dry_run else 'Import'} Summary ---")
+            print(f"Total unique visits prepared for batching: {self.visit_grouper.unique_visits} "
+                  f"({'would be sent' if dry_run else 'sent'} as {stats.items_sent} items in batches)")
+            if self.visit_grouper.reappeared_rows:
+                print(f"Skipped {self.visit_grouper.reappeared_rows} rows of {len(self.visit_grouper.reappeared_keys)} visits that reappeared "
+                      f"after the visit was sent (more than VISIT_GROUP_WINDOW = {self.visit_grouper.window} visits apart); "
+                      f"those visits only have their earlier rows.")
+            if dry_run:
+                return
+            print(f"Successfully imported visits reported by server: {stats.success_count}")
+            print(f"Total visit batches resulting in errors: {stats.failed_batches}")
+            print(f"Individual visit failures reported by server: {stats.failure_reports} (every attempt, including visits "
+                  f"that succeeded when re-queued)")
+            print(f"Visits still failing after their last attempt: {stats.items_given_up}")
+            self.print_retry_summary(stats, "visits")
+            if stats.detailed_failures:
+                print("Details of visits that still failed server-side processing (first 10 shown):")
+                for failure in stats.detailed_failures[:10]:
+                    print(f"  - PReg: {failure.get('patientId', 'N/A')}, VisitDate: {failure.get('visitDate', failure.get('item',{}).get('visitData',{}).get('visitDate','N/A'))}, Reason: {failure.get('error', failure.get('reason', 'Unknown'))}")
+        if self.journal:
+            print(f"\nCheckpoint journal: {self.journal.path} (re-run with --resume to retry failures or continue after a crash)")
+
+    def print_retry_summary(self, stats, item_name):
+        if stats.batch_retries or stats.batches_split:
+            print(f"Whole-batch re-sends after errors: {stats.batch_retries}; batches split to isolate failing records: {stats.batches_split}")
+        if stats.items_requeued or stats.items_given_up:
+            print(f"Failed {item_name} re-queued into later batches: {stats.items_requeued}; "
+                  f"still failing and kept in the journal for --resume: {stats.items_given_up}")
+
+def default_journal_path(csv_path=None):
+    if CHECKPOINT_JOURNAL_PATH and csv_path is None:
+        return CHECKPOINT_JOURNAL_PATH
+    return f"{csv_path or CSV_FILE_PATH}.import-journal.jsonl"
+
+def default_delta_index_path():
+    if DELTA_INDEX_PATH:
+        return DELTA_INDEX_PATH
+    host = re.sub(r'[^A-Za-z0-9.-]', '_', TARGET_HOST)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), f"import-index.{host}.sqlite")
+
+def expand_csv_paths(paths):
+    """Expands directories into the .csv / .csv.gz files directly inside them, sorted by name."""
+    csv_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            csv_paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                    if name.lower().endswith(('.csv', '.csv.gz')) and os.path.isfile(os.path.join(path, name))))
+        else:
+            csv_paths.append(path)
+    # The same file named twice (e.g. directly and through its directory) is read once.
+    return list(dict.fromkeys(os.path.abspath(path) for path in csv_paths))
+
+def load_resume_state(journal_path, import_demographics, import_visits):
+    """Returns (resume_state or None, ok). ok is False if the journal was written for another import mode."""
+    if not os.path.exists(journal_path):
+        print(f"No checkpoint journal at {journal_path}; starting from the beginning.")
+        return None, True
+    resume_state = CheckpointJournal.load(journal_path)
+    if resume_state.import_demographics is not None and (
+            resume_state.import_demographics != import_demographics or resume_state.import_visits != import_visits):
+        print(f"FATAL: Journal {journal_path} was written for a different import mode "
+              f"(demographics={resume_state.import_demographics}, visits={resume_state.import_visits}).")
+        return None, False
+    print(f"Loaded checkpoint journal {journal_path}: {len(resume_state.completed_pregs)} patients acknowledged, "
+          f"{len(resume_state.failed_patients)} failed patients and {len(resume_state.failed_visits)} failed visits to retry.")
+    return resume_state, True
+
+def import_patients_and_visits(import_demographics=True, import_visits=True, max_in_flight=MAX_IN_FLIGHT_REQUESTS,
+                               resume=False, journal_path=None, delta=False, delta_index_path=None,
+                               delta_include_changed_visits=False, parse_workers=PARSE_WORKERS, metrics=None,
+                               metrics_file=None, metrics_interval=METRICS_REPORT_INTERVAL_SECONDS, retry_policy=None,
+                               wire_format=WIRE_FORMAT, gzip_bodies=GZIP_REQUEST_BODIES, csv_paths=None,
+                               file_workers=FILE_WORKERS, only_pregs=None, search_index_path=SEARCH_INDEX_PATH,
+                               dry_run=False):
+    """Single-pass import: reads the CSV once and sends patient and visit batches as it goes.
+
+    With resume=True the checkpoint journal of a previous run is replayed: completed work
+    is skipped and only the items that failed are sent again. With delta=True only records
+    that are new or changed since the last delta import are sent (the first delta run
+    sends everything and builds the index).
+
+    Pass an ImportMetrics as metrics to collect per-stage timings and counters (read its
+    snapshot() afterwards); metrics_file also appends them as JSON lines every
+    metrics_interval seconds, plus a final line. retry_policy overrides the RETRY_* defaults.
+    wire_format and gzip_bodies choose how batch bodies are encoded (see WIRE_FORMAT).
+
+    csv_paths imports several CSV files (or every .csv / .csv.gz in a directory) instead
+    of CSV_FILE_PATH, up to file_workers at a time. Each file keeps its own checkpoint
+    journal (the delta index is shared, see DELTA_INDEX_PATH); demographics
+    are sent once per PReg across all files and the PReg counter is set once, to the
+    highest PReg of any file.
+
+    only_pregs re-imports just the rows of those PRegs, located through each CSV's row
+    index. Such a run keeps no checkpoint journal and leaves the PReg counter alone.
+
+    search_index_path adds every patient the server acknowledges to that patient search
+    index file (see PatientSearchIndex), creating it on the first run.
+
+    dry_run reads, validates, groups and batches everything without any network access
+    (see DryRunDispatcher) and prints a validation report and batch profile instead.
+    Nothing is written to the journal, delta index or search index and the PReg counter
+    is left alone; with resume or delta, the report covers what would be sent.
+    """
+    paths = expand_csv_paths(csv_paths) if csv_paths else [CSV_FILE_PATH]
+    if not paths:
+        print(f"FATAL: No CSV files found in {', '.join(csv_paths)}.")
+        return
+    missing_paths = [path for path in paths if not os.path.isfile(path)]
+    if missing_paths:
+        # Checked before any journal or delta index is created for the files
+        for path in missing_paths:
+            print(f"FATAL Error: CSV file not found at {path}.")
+        return
+    if only_pregs is not None and resume:
+        print("FATAL: --resume cannot be combined with importing selected PRegs.")
+        return
+    if journal_path and len(paths) > 1:
+        print("FATAL: A journal path can only be given for a single CSV file; with several files each "
+              "uses <CSV path>.import-journal.jsonl.")
+        return
+
+    plans = [] # (csv path, journal path, resume state)
+    for path in paths:
+        file_journal_path = journal_path or default_journal_path(path if csv_paths else None)
+        resume_state = None
+        if resume:
+            resume_state, ok = load_resume_state(file_journal_path, import_demographics, import_visits)
+            if not ok:
+                return
+        plans.append((path, file_journal_path, resume_state))
+
+    delta_index = None
+    if delta:
+        index_path = delta_index_path or default_delta_index_path()
+        if dry_run and not os.path.exists(index_path):
+            print(f"Delta mode: no content-hash index at {index_path} yet, so everything counts as new (a dry run does not create it).")
+        else:
+            delta_index = ContentHashIndex(index_path)
+            print(f"Delta mode: comparing against content-hash index {delta_index.path}")
+
+    if metrics_file and metrics is None:
+        metrics = ImportMetrics()
+    if metrics_file:
+        metrics.start_reporting(metrics_file, metrics_interval)
+        print(f"Writing import metrics to {metrics_file} every {metrics_interval:g} s")
+    metrics = metrics or DISABLED_METRICS
+
+    search_index = None
+    if search_index_path and import_demographics and not dry_run:
+        search_index = PatientSearchIndex(search_index_path)
+
+    retry_policy = retry_policy or RetryPolicy()
+    dry_run_report = DryRunReport() if dry_run else None
+    if dry_run:
+        dispatcher = DryRunDispatcher(metrics, gzip_bodies)
+    else:
+        dispatcher = BatchDispatcher(max_in_flight, metrics, retry_policy, gzip_bodies)
+    patient_registry = PatientRegistry()
+    importers = []
+    journals = []
+    try:
+        for path, file_journal_path, resume_state in plans:
+            journal = None
+            # A partial or dry run must not leave watermarks that a later --resume would trust
+            if only_pregs is None and not dry_run:
+                journal = CheckpointJournal(file_journal_path)
+                journals.append(journal)
+                journal.open(path, resume_state is not None, import_demographics, import_visits)
+            importers.append(StreamingImporter(import_demographics=import_demographics, import_visits=import_visits,
+                                               max_in_flight=max_in_flight, journal=journal, resume_state=resume_state,
+                                               delta_index=delta_index, delta_include_changed_visits=delta_include_changed_visits,
+                                               parse_workers=parse_workers, metrics=metrics, retry_policy=retry_policy,
+                                               wire_format=wire_format, gzip_bodies=gzip_bodies, csv_path=path,
+                                               dispatcher=dispatcher, patient_registry=patient_registry,
+                                               only_pregs=only_pregs, search_index=search_index,
+                                               dry_run_report=dry_run_report))
+
+        run_started = time.perf_counter()
+        if len(importers) == 1:
+            succeeded = [importers[0].run()]
+        else:
+            print(f"Importing {len(importers)} CSV files, {min(file_workers, len(importers))} at a time, "
+                  f"sharing {max_in_flight} in-flight batches.")
+            with ThreadPoolExecutor(max_workers=max(1, file_workers), thread_name_prefix="csv-file") as file_executor:
+                succeeded = list(file_executor.map(StreamingImporter.run, importers))
+        run_seconds = time.perf_counter() - run_started
+    finally:
+        dispatcher.shutdown()
+        for journal in journals:
+            journal.close()
+        if delta_index is not None:
+            delta_index.close()
+        if search_index is not None:
+            search_index.save() # Acknowledged patients are in Firestore even if the run failed
+        if metrics_file: metrics.stop_reporting()
+    if not all(succeeded):
+        return
+
+    for importer in importers:
+        if len(importers) > 1:
+            print(f"\n=== {importer.csv_path} ===")
+        importer.print_summary()
+    if metrics.enabled:
+        metrics.print_report()
+    if dry_run:
+        dry_run_report.print_report(run_seconds, dispatcher, max_in_flight)
+        return
+
+    # After all patient demographics are processed, update the counter once, from every file
+    # (not after importing selected PRegs, whose maximum may be below the real counter)
+    if import_demographics and only_pregs is None:
+        max_preg_number = max(importer.max_preg_val_from_csv for importer in importers)
+        if max_preg_number > 0:
+            update_pReg_counter_in_firestore(max_preg_number)
+        else:
+            print("\nNo valid PReg numbers found in CSV to update the counter.")
+
+def import_patients():
+    """Imports patient demographics only (and sets the PReg counter)."""
+    import_patients_and_visits(import_demographics=True, import_visits=False)
+
+def import_historical_visits():
+    """Imports historical visits only; patients are expected to exist already."""
+    print("\n--- Starting Historical Visit Import ---BATCH MODE---")
+    import_patients_and_visits(import_demographics=False, import_visits=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import patients and historical visits from the clinic CSV.")
+    parser.add_argument("csv_paths", nargs="*", metavar="CSV",
+                        help="CSV files (.csv or .csv.gz) or directories of them, e.g. one export per branch "
+                             "(default: CSV_FILE_PATH).")
+    parser.add_argument("--file-workers", type=int, default=FILE_WORKERS,
+                        help=f"CSV files imported at the same time when several are given (default: {FILE_WORKERS}).")
+    parser.add_argument("--concurrency", type=int, default=MAX_IN_FLIGHT_REQUESTS,
+                        help=f"Number of batches kept in flight at once (default: {MAX_IN_FLIGHT_REQUESTS}).")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue from the checkpoint journal of a previous run, retrying only failed items.")
+    parser.add_argument("--journal", default=None,
+                        help="Checkpoint journal path (default: <CSV path>.import-journal.jsonl).")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only send patients and visits that are new or changed since the last --delta run.")
+    parser.add_argument("--delta-index", default=None,
+                        help="Content-hash index path for --delta (default: import-index.<target host>.sqlite next to this script, "
+                             "shared by every export).")
+    parser.add_argument("--delta-include-changed-visits", action="store_true",
+                        help="With --delta, also re-send visits whose content changed (visits imported by an older server are added again).")
+    parser.add_argument("--parse-workers", type=int, default=PARSE_WORKERS,
+                        help=f"Worker processes used to parse and normalize CSV rows (default: {PARSE_WORKERS}, i.e. inline).")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Collect per-stage timings and counters and print them at the end.")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Append import metrics to this file as JSON lines while running (implies --metrics).")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_REPORT_INTERVAL_SECONDS,
+                        help=f"Seconds between --metrics-file lines (default: {METRICS_REPORT_INTERVAL_SECONDS:g}).")
+    parser.add_argument("--wire-format", choices=["json", "dict"], default=WIRE_FORMAT,
+                        help=f"Batch body encoding: compact JSON, or dictionary-encoded JSON that the functions expand (default: {WIRE_FORMAT}).")
+    parser.add_argument("--no-gzip", action="store_true",
+                        help="Send batch bodies uncompressed instead of with Content-Encoding: gzip.")
+    parser.add_argument("--search-index", default=SEARCH_INDEX_PATH, metavar="PATH",
+                        help="Add imported patients to this patient search index file for local type-ahead in the front end "
+                             "(updated in place on later runs, including --delta runs).")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Read, validate and batch the CSV without sending anything; prints data problems and a "
+                             "batch profile (request count, batch sizes, visits per PReg).")
+    parser.add_argument("--only-pregs", default=None, metavar="PREGS",
+                        help="Re-import just these PRegs: comma-separated, or @file with one PReg per line. Rows are found "
+                             "through the CSV's row index; visits are added again, so pair with --delta to skip unchanged ones.")
+    return parser.parse_args()
+
+def read_preg_list(value):
+    """Parses --only-pregs: "PR-1,PR-2" or "@path" to a file with one PReg per line."""
+    if value.startswith('@'):
+        with open(value[1:], encoding='utf-8') as preg_file:
+            value = preg_file.read().replace('\n', ',')
+    return [preg.strip() for preg in value.split(',') if preg.strip()]
+
+if __name__ == "__main__":
+    args = parse_args()
+    # To run a full import:
+    # 1. Ensure USE_EMULATOR is set correctly at the top of the script.
+    # 2. Run the script. Patients and visits are imported in a single pass over the CSV;
+    #    patient batches are always sent before visit batches that reference them.
+    #    This also sets the PReg counter.
+    # 3. If the run is interrupted, run it again with --resume.
+    # 4. For daily re-syncs of a newer export, use --delta to send only new or changed records.
+    # 5. To import the exports of several branches together, pass the files or their directory.
+    # 6. Pass --search-index to also write the patient search file loaded by patient_search_index.js.
+    # 7. To re-import a few patients, use --only-pregs (the CSV's .rowindex file makes this a direct read).
+    # 8. Before importing a new export, run it with --dry-run to check the data and size the import offline.
+    import_patients_and_visits(max_in_flight=args.concurrency, resume=args.resume, journal_path=args.journal,
+                               delta=args.delta, delta_index_path=args.delta_index,
+                               delta_include_changed_visits=args.delta_include_changed_visits,
+                               parse_workers=args.parse_workers,
+                               metrics=ImportMetrics() if args.metrics or args.metrics_file else None,
+                               metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                               wire_format=args.wire_format, gzip_bodies=not args.no_gzip,
+                               csv_paths=args.csv_paths or None, file_workers=args.file_workers,
+                               only_pregs=read_preg_list(args.only_pregs) if args.only_pregs else None,
+                               search_index_path=args.search_index, dry_run=args.dry_run)
 
-    print("\nScript finished. Uncomment calls in __main__ to perform actions.")
\ No newline at end of file
+    print("\nScript finished.")
@@ -0,0 +1,203 @@
+import array
+import bisect
+import csv
+import json
+import mmap
+import os
+import sys
+
+# Memory-mapped reader for the clinic CSV exports with a row index kept next to the CSV.
+# Used by import_patients_from_csv.py and generate_medication_json_from_csv.py.
+
+INDEX_SUFFIX = ".rowindex"
+INDEX_MAGIC = b"CSVROWIDX1\n"
+PREG_COLUMN_NAME = "PReg"
+
+class IndexedCSV:
+    """Reads a CSV file through mmap and indexes where every row starts.
+
+    Rows are yielded as (byte offset, row) where row is the csv.reader list of fields in
+    header order (use column() for positions), rather than a dict per row.
+
+    The index holds the byte offset of every data row and, for each PReg, the ranges of
+    consecutive rows that belong to it. It is built during the first full pass over the
+    file (or by build_index()) and saved to "<csv path>.rowindex"; later opens load it as
+    long as the CSV's size and modification time are unchanged. With the index, a resume
+    offset, a worker's share of the file or the rows of a few PRegs are read directly
+    instead of scanning the whole file.
+    """
+
+    def __init__(self, path, index_path=None, load_index=True):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self.file = open(path, mode='rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mtime_ns = os.fstat(self.file.fileno()).st_mtime_ns
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.offset = 0
+        self.bytes_read = 0 # Data bytes read through iter_rows(), for throughput metrics
+        self.fieldnames = None
+        self.data_offset = 0
+        self.row_offsets = None # array('Q') of data row start offsets, once indexed
+        self.preg_ranges = None # PReg -> [[first row, end row), ...]
+        if self.mm is not None:
+            header_line = self.mm.readline()
+            self.data_offset = len(header_line)
+            self.offset = self.data_offset
+            header = next(csv.reader([header_line.decode('utf-8').lstrip('\ufeff')]), None)
+            self.fieldnames = header or None
+        if load_index and self.fieldnames:
+            self.load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.file.close()
+
+    def column(self, name):
+        """Position of a header column, or None."""
+        try:
+            return self.fieldnames.index(name)
+        except (AttributeError, ValueError):
+            return None
+
+    @property
+    def has_index(self):
+        return self.row_offsets is not None
+
+    @property
+    def row_count(self):
+        return len(self.row_offsets) if self.row_offsets is not None else None
+
+    def seek(self, offset):
+        """Makes the next iteration start at offset, which must be where a row starts."""
+        self.offset = max(offset, self.data_offset)
+
+    def _lines(self, start, end):
+        mm = self.mm
+        mm.seek(start)
+        self.offset = start
+        while end is None or self.offset < end:
+            line = mm.readline()
+            if not line:
+                return
+            self.offset += len(line)
+            self.bytes_read += len(line)
+            yield line.decode('utf-8')
+
+    def iter_rows(self, start_offset=None, end_offset=None):
+        """Yields (offset, row) for the rows starting in [start_offset, end_offset).
+
+        A full pass from the first data row to the end of the file also builds the index
+        and saves it, if there is none yet.
+        """
+        if self.mm is None or not self.fieldnames:
+            return
+        start = self.offset if start_offset is None else max(start_offset, self.data_offset)
+        building = self.row_offsets is None and start == self.data_offset and end_offset is None
+        if building:
+            row_offsets = array.array('Q')
+            preg_ranges = {}
+            preg_position = self.column(PREG_COLUMN_NAME)
+            current_preg, run_start = None, 0
+
+        row_offset = start
+        for row_number, row in enumerate(csv.reader(self._lines(start, end_offset))):
+            if building:
+                row_offsets.append(row_offset)
+                preg = row[preg_position].strip() if preg_position is not None and preg_position < len(row) else ''
+                if preg != current_preg:
+                    if current_preg:
+                        preg_ranges.setdefault(current_preg, []).append([run_start, row_number])
+                    current_preg, run_start = preg, row_number
+            yield row_offset, row
+            row_offset = self.offset
+
+        if building:
+            if current_preg:
+                preg_ranges.setdefault(current_preg, []).append([run_start, len(row_offsets)])
+            self.row_offsets = row_offsets
+            self.preg_ranges = preg_ranges
+            self.save_index()
+
+    def __iter__(self):
+        return self.iter_rows()
+
+    def build_index(self):
+        """Scans the whole file to build (and save) the index if it has none."""
+        if self.row_offsets is None:
+            for _ in self.iter_rows(self.data_offset):
+                pass
+
+    def load_index(self):
+        """Loads the sidecar index if it matches the CSV. Returns whether it was loaded."""
+        try:
+            with open(self.index_path, mode='rb') as index_file:
+                if index_file.readline() != INDEX_MAGIC:
+                    return False
+                meta = json.loads(index_file.readline())
+                if meta.get("size") != self.size or meta.get("mtimeNs") != self.mtime_ns or meta.get("header") != self.fieldnames:
+                    return False
+                row_offsets = array.array('Q')
+                row_offsets.frombytes(index_file.read(meta["rowCount"] * row_offsets.itemsize))
+        except (OSError, ValueError, KeyError):
+            return False
+        if len(row_offsets) != meta["rowCount"]:
+            return False
+        if meta.get("byteOrder") != sys.byteorder:
+            row_offsets.byteswap()
+        self.row_offsets = row_offsets
+        self.preg_ranges = meta.get("pregRanges", {})
+        return True
+
+    def save_index(self):
+        """Writes the index next to the CSV (atomically; failures only cost a rebuild later)."""
+        meta = {"size": self.size, "mtimeNs": self.mtime_ns, "header": self.fieldnames, "byteOrder": sys.byteorder,
+                "rowCount": len(self.row_offsets), "pregRanges": self.preg_ranges}
+        temp_path = f"{self.index_path}.tmp"
+        try:
+            with open(temp_path, mode='wb') as index_file:
+                index_file.write(INDEX_MAGIC)
+                index_file.write(json.dumps(meta, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b"\n")
+                index_file.write(self.row_offsets.tobytes())
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Warning: could not save CSV row index {self.index_path}: {e}")
+
+    def row_at_offset(self, offset):
+        """Index of the row starting at or containing offset (requires the index)."""
+        return max(0, bisect.bisect_right(self.row_offsets, offset) - 1)
+
+    def row_start(self, row_number):
+        """Byte offset where a row starts; the end of the file for row_count."""
+        return self.row_offsets[row_number] if row_number < len(self.row_offsets) else self.size
+
+    def preg_end_offset(self, preg):
+        """Byte offset just past the last row of a PReg, or None if it has no rows (requires the index)."""
+        ranges = self.preg_ranges.get(preg)
+        return self.row_start(ranges[-1][1]) if ranges else None
+
+    def byte_ranges(self, start_offset, chunk_bytes):
+        """Splits [start_offset, end of file) into ranges of about chunk_bytes on row boundaries (requires the index)."""
+        ranges = []
+        row_number = self.row_at_offset(start_offset) if start_offset > self.data_offset else 0
+        start = max(start_offset, self.data_offset)
+        while start < self.size:
+            row_number = bisect.bisect_left(self.row_offsets, start + chunk_bytes, lo=row_number + 1)
+            end = self.row_start(row_number)
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def iter_preg_rows(self, pregs):
+        """Yields (offset, row) for every row of the given PRegs, in file order (requires the index)."""
+        ranges = sorted(row_range for preg in set(pregs) for row_range in self.preg_ranges.get(preg, []))
+        for first_row, end_row in ranges:
+            yield from self.iter_rows(self.row_offsets[first_row], self.row_start(end_row))
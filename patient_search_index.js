@@ -0,0 +1,58 @@
+// Local type-ahead over the patient search index written by import_patients_from_csv.py --search-index.
+// The file lists patients as [pReg, name, contactNo, nicNo] rows plus a sorted array of search keys
+// (name_normalized, its later words, lower-cased PReg, digits of contactNo / nicNo) with a parallel
+// array of row numbers, so a prefix lookup is a binary search and a short scan.
+class PatientSearchIndex {
+    constructor(data) {
+        this.patients = data.patients;
+        this.keys = data.keys;
+        this.refs = data.refs;
+    }
+
+    static async load(url) {
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`Failed to load patient search index: ${response.status}`);
+        }
+        const data = await response.json();
+        if (data.version !== 1) {
+            throw new Error(`Unsupported patient search index version: ${data.version}`);
+        }
+        return new PatientSearchIndex(data);
+    }
+
+    // First index of a key >= prefix.
+    lowerBound(prefix) {
+        let low = 0;
+        let high = this.keys.length;
+        while (low < high) {
+            const middle = (low + high) >>> 1;
+            if (this.keys[middle] < prefix) low = middle + 1;
+            else high = middle;
+        }
+        return low;
+    }
+
+    // Returns up to limit patients whose name, a word of it, PReg, contact or NIC number starts with query,
+    // shaped like searchPatients results ({ id, pReg, name, contactNo, nicNo }) without the other fields.
+    search(query, limit = 10) {
+        const normalized = query.trim().toLowerCase();
+        if (!normalized) return [];
+        const prefixes = [normalized];
+        const digits = normalized.replace(/\D/g, "");
+        if (digits && digits !== normalized && /^[\d\s+()-]+$/.test(normalized)) prefixes.push(digits);
+
+        const rowNumbers = new Set();
+        for (const prefix of prefixes) {
+            for (let i = this.lowerBound(prefix); i < this.keys.length && this.keys[i].startsWith(prefix); i++) {
+                rowNumbers.add(this.refs[i]);
+                if (rowNumbers.size >= limit) break;
+            }
+            if (rowNumbers.size >= limit) break;
+        }
+        return [...rowNumbers].map(rowNumber => {
+            const [pReg, name, contactNo, nicNo] = this.patients[rowNumber];
+            return { id: pReg, pReg, name, contactNo, nicNo, fromSearchIndex: true }; // Imported patients use the PReg as document ID
+        });
+    }
+}
@@ -79,6 +79,16 @@ document.addEventListener('DOMContentLoaded', async () => {
     const savePatientVisitFunctionUrl = useEmulator ? `${localBaseUrl}/savePatientVisit` : "https://savepatientvisit-pzytr7bzwa-uc.a.run.app";
     const getLastPatientVisitFunctionUrl = useEmulator ? `${localBaseUrl}/getLastPatientVisit` : "https://getlastpatientvisit-pzytr7bzwa-uc.a.run.app";
     const getAllPatientVisitsFunctionUrl = useEmulator ? `${localBaseUrl}/getAllPatientVisits` : "https://getallpatientvisits-pzytr7bzwa-uc.a.run.app";
+    // Patient search index written by import_patients_from_csv.py --search-index (null = always use searchPatients).
+    // It contains patient names and phone/NIC numbers, so only serve it to signed-in staff.
+    const patientSearchIndexUrl = null;
+
+    let patientSearchIndex = null;
+    if (patientSearchIndexUrl && typeof PatientSearchIndex !== 'undefined') {
+        PatientSearchIndex.load(patientSearchIndexUrl)
+            .then(index => { patientSearchIndex = index; })
+            .catch(error => console.warn('Patient search index not loaded, using searchPatients:', error));
+    }
 
     // --- Initialize & Load Data ---
     // (Existing medication loading logic - can be kept or removed if not used client-side anymore)
@@ -401,16 +411,25 @@ document.addEventListener('DOMContentLoaded', async () => {
             return;
         }
 
+        // Imported patients are found locally; only ask the server when that gives fewer than 5
+        // (e.g. patients registered after the last import).
+        const localPatients = patientSearchIndex ? patientSearchIndex.search(query, 5) : [];
+        if (localPatients.length > 0) displayPatientSuggestions(localPatients);
+        if (localPatients.length >= 5) return;
+
         try {
             const response = await fetch(`${searchPatientsFunctionUrl}?q=${encodeURIComponent(query)}&limit=5`);
             if (!response.ok) {
                 console.error('Error searching patients:', response.statusText);
+                if (localPatients.length > 0) return;
                 patientNameSuggestionsDiv.innerHTML = '';
                 patientNameSuggestionsDiv.style.display = 'none';
                 return;
             }
             const patients = await response.json();
-            displayPatientSuggestions(patients);
+            if (patientNameInput.value.trim().toLowerCase() !== query) return; // A newer keystroke has taken over
+            const localIds = new Set(localPatients.map(patient => patient.id));
+            displayPatientSuggestions([...localPatients, ...patients.filter(patient => !localIds.has(patient.id))].slice(0, 5));
         } catch (error) {
             console.error('Error fetching patient suggestions:', error);
             patientNameSuggestionsDiv.innerHTML = '';
@@ -433,7 +452,8 @@ document.addEventListener('DOMContentLoaded', async () => {
             if (patient.pReg) displayText += ` (ID: ${patient.pReg})`;
             else if (patient.contactNo) displayText += ` (Contact: ${patient.contactNo})`;
             li.textContent = displayText;
-            li.addEventListener('click', () => selectPatient(patient));
+            // Search index entries only hold name / PReg / numbers, so load the full patient first
+            li.addEventListener('click', () => patient.fromSearchIndex ? fetchPatientByIdAndSelect(patient.id) : selectPatient(patient));
             ul.appendChild(li);
         });
         patientNameSuggestionsDiv.appendChild(ul);